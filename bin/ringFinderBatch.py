@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+from labnanofisica.ringfinder.headless import main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the ring finder. Times the correlation method, the direction
+finding, the splitting in blocks and discrimination, the FFT scoring of all
+blocks, and the complete batch analysis on the bundled images and synthetic
+ones of several sizes, for several angular steps and numbers of worker
+processes, for example
+
+    python bin/ringFinderBenchmark.py -o today.json --baseline before.json
+
+Results are saved as json and compared with a baseline file, if given.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import multiprocessing as mp
+import numpy as np
+import tifffile as tiff
+
+import matplotlib
+matplotlib.use('Agg')
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.templates as templates
+import labnanofisica.ringfinder.pipeline as pipeline
+import labnanofisica.ringfinder.headless as headless
+import labnanofisica.ringfinder.neurosimulations as sim
+
+folder = os.path.dirname(os.path.abspath(__file__))
+bundledImages = {'spectrinSTED': ('STED', 'spectrinSTED.tif'),
+                 'spectrinSTORM': ('STORM', 'spectrinSTORM.tif')}
+
+# Benchmarks are identified by these fields when compared with a baseline
+keyFields = ('benchmark', 'image', 'thStep', 'nworkers')
+
+
+def syntheticImage(size, pxSize=20, wvlen=180, neuronFrac=0.7, seed=0):
+    """Image of about size x size px made of 1um blocks, neuronFrac of them
+    with a simulated axon (neurosimulations.simAxon) of random orientation and
+    phase and the rest with background only, with poisson noise.
+
+    pxSize, wvlen: pixel size and ring periodicity in nm"""
+
+    rng = np.random.RandomState(seed)
+    blockSize = int(round(1000/pxSize))
+    n = max(size//blockSize, 1)
+
+    image = np.zeros((n*blockSize, n*blockSize))
+    for i in np.arange(n):
+        for j in np.arange(n):
+            if rng.rand() < neuronFrac:
+                axon = sim.simAxon(imSize=blockSize, wvlen=wvlen/pxSize,
+                                   theta=rng.uniform(0, 180), phase=rng.rand(),
+                                   b=2).data
+                image[i*blockSize:(i + 1)*blockSize,
+                      j*blockSize:(j + 1)*blockSize] = 100*axon + 20
+
+    return rng.poisson(image + 5).astype(np.uint16)
+
+
+def timeIt(function, repeat=3):
+    """Best wall time of repeat calls of function, in seconds. The template
+    bank is emptied before each call, so every call starts like a new analysis
+    process and worker processes don't inherit templates of previous calls."""
+
+    times = []
+    for r in np.arange(repeat):
+        templates.bank.clear()
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+
+    return min(times)
+
+
+def record(benchmark, image, seconds, nblocks, thStep=None, nworkers=1,
+           **extra):
+    nblocks = int(nblocks)
+    result = {'benchmark': benchmark, 'image': image, 'thStep': thStep,
+              'nworkers': int(nworkers), 'seconds': seconds,
+              'blocks': nblocks,
+              'blocksPerSec': nblocks/seconds if seconds > 0 else None}
+    result.update(extra)
+    return result
+
+
+def benchImage(name, data, args, thSteps, workers, repeat=3, nfiles=4,
+               maxBlocks=50, corrThres=None):
+    """Benchmarks of one image.
+
+    data: image, not cropped
+    args: pxSize, crop, gaussSigma, intThr, cArgs, see headless.analysisArgs
+    thSteps: angular steps to time corrMethod and the batch analysis with
+    workers: numbers of worker processes of the batch analysis
+    repeat: times each benchmark is repeated, the best time is kept
+    nfiles: number of copies of the image in the batch analysis
+    maxBlocks: number of neuron blocks the direction finding and corrMethod
+        are timed with
+    corrThres: discrimination threshold of the batch analysis and
+        corrDecision, by default the one of tools.analysisDefaults
+
+    returns a list with the results of each benchmark"""
+
+    pxSize, crop, gaussSigma, intThr, cArgs = args
+    if corrThres is None:
+        corrThres = float(tools.analysisDefaults['Discrimination threshold'])
+    dataShape = (data.shape[0] - 2*crop, data.shape[1] - 2*crop)
+    inputData = data[crop:crop + dataShape[0],
+                     crop:crop + dataShape[1]].astype(np.float64)
+    n = (np.array(dataShape)/(1000/pxSize)).astype(int)
+    nblocks = np.array(dataShape)/n
+    shape = {'shape': list(data.shape), 'grid': [int(v) for v in n]}
+    results = []
+
+    # Smoothing, binarization, blockshaped and discrimination
+    def prepare():
+        output = pipeline.prepareImage(inputData, gaussSigma/pxSize, intThr,
+                                       nblocks)
+        blocksInput, blocksInputS, blocksMask, thres, directions = output
+        neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+        gate = np.logical_and(np.any(blocksInputS > thres, (1, 2)),
+                              neuronFrac > 0.25)
+        return output, gate
+
+    seconds = timeIt(prepare, repeat)
+    results.append(record('blocks', name, seconds, n[0]*n[1], **shape))
+
+    output, gate = prepare()
+    blocksInput, blocksInputS, blocksMask, thres, directions = output
+
+    seconds = timeIt(lambda: tools.FFTBlocks(blocksInput), repeat)
+    results.append(record('FFTBlocks', name, seconds, len(blocksInput),
+                          **shape))
+    sample = np.where(gate)[0][:maxBlocks]
+    if len(sample) == 0:
+        return results
+
+    def direction():
+        for i in sample:
+            tools.getDirection(blocksInput[i], ~blocksMask[i], cArgs[0])
+
+    seconds = timeIt(direction, repeat)
+    results.append(record('getDirection', name, seconds, len(sample),
+                          **shape))
+
+    for thStep in thSteps:
+        stepArgs = (cArgs[0], thStep) + tuple(cArgs[2:])
+
+        def correlation():
+            for i in sample:
+                tools.corrMethod(blocksInput[i], blocksMask[i], *stepArgs,
+                                 direction=directions[i])
+
+        seconds = timeIt(correlation, repeat)
+        results.append(record('corrMethod', name, seconds, len(sample),
+                              thStep, **shape))
+
+        def decision():
+            for i in sample:
+                tools.corrDecision(blocksInput[i], blocksMask[i], corrThres,
+                                   *stepArgs, direction=directions[i])
+
+        seconds = timeIt(decision, repeat)
+        results.append(record('corrDecision', name, seconds, len(sample),
+                              thStep, **shape))
+
+    # Complete batch analysis, as run by the GUI, of copies of the image
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in np.arange(nfiles):
+            files.append(os.path.join(tmp, 'image{}.tif'.format(i)))
+            tiff.imwrite(files[-1], data)
+
+        for thStep in thSteps:
+            stepArgs = (cArgs[0], thStep) + tuple(cArgs[2:])
+            serialRate = None
+            for nworkers in workers:
+
+                def batch():
+                    analysis = pipeline.Pipeline(files, pxSize, crop,
+                                                 gaussSigma, intThr, stepArgs,
+                                                 nworkers=nworkers)
+                    analysis.run()
+                    analysis.saveRings(corrThres)
+                    analysis.close()
+
+                seconds = timeIt(batch, repeat)
+                result = record('pipeline', name, seconds,
+                                nfiles*n[0]*n[1], thStep, nworkers, **shape)
+
+                # Scaling efficiency relative to the single worker analysis
+                if nworkers == 1:
+                    serialRate = result['blocksPerSec']
+                if serialRate is not None:
+                    result['efficiency'] = (result['blocksPerSec'] /
+                                            (serialRate*nworkers))
+                results.append(result)
+
+    return results
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': sys.version.split()[0],
+            'numpy': np.__version__, 'cpus': mp.cpu_count()}
+
+
+def compare(results, baseline, tolerance=0.1, stream=sys.stdout):
+    """Prints the speed of every benchmark relative to the baseline (a list of
+    results as returned by benchImage).
+
+    returns the number of benchmarks slower than the baseline by more than
+    the tolerance fraction"""
+
+    def key(result):
+        return tuple(result.get(field) for field in keyFields)
+
+    previous = {key(r): r for r in baseline}
+    text = '{0:<14}{1:<16}{2:>8}{3:>9}{4:>14}{5:>14}{6:>9}  {7}\n'
+    stream.write(text.format('benchmark', 'image', 'thStep', 'workers',
+                             'blocks/s', 'baseline', 'ratio', ''))
+
+    nslower = 0
+    for result in results:
+        base = previous.get(key(result))
+        if base is None or not base['blocksPerSec']:
+            stream.write(text.format(*[str(v) for v in key(result)],
+                                     '{:.1f}'.format(result['blocksPerSec']),
+                                     '-', '-', 'new'))
+            continue
+
+        ratio = result['blocksPerSec']/base['blocksPerSec']
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = 'SLOWER'
+            nslower += 1
+        elif ratio > 1 + tolerance:
+            flag = 'faster'
+        stream.write(text.format(*[str(v) for v in key(result)],
+                                 '{:.1f}'.format(result['blocksPerSec']),
+                                 '{:.1f}'.format(base['blocksPerSec']),
+                                 '{:.2f}'.format(ratio), flag))
+
+    return nslower
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the ring finder analysis.')
+    parser.add_argument('-o', '--output', default='ringfinder_benchmark.json',
+                        help='json file the results are saved to')
+    parser.add_argument('--baseline', default=None,
+                        help='json file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction of speed loss reported as slower')
+    parser.add_argument('-c', '--config', default=None,
+                        help='config file with the analysis settings, by '
+                             'default the built-in ones')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[500, 1000],
+                        help='sizes in px of the synthetic images')
+    parser.add_argument('--thsteps', type=float, nargs='+', default=[3., 6.],
+                        help='angular steps in deg')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, mp.cpu_count()}),
+                        help='numbers of worker processes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times each benchmark is repeated')
+    parser.add_argument('--files', type=int, default=4,
+                        help='number of images of the batch analysis')
+    parser.add_argument('--no-bundled', action='store_true',
+                        help="don't benchmark the bundled images")
+    parser.add_argument('--quick', action='store_true',
+                        help='only the 500 px synthetic image, the first '
+                             'angular step, one worker and one repetition')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.sizes = [500]
+        args.thsteps = args.thsteps[:1]
+        args.workers = [1]
+        args.repeat = 1
+        args.no_bundled = True
+
+    if args.config is not None and not os.path.exists(args.config):
+        parser.error('config file ' + args.config + ' not found')
+
+    # Without a config file only the default settings are used, so results
+    # don't depend on the working directory
+    config = tools.readConfig(args.config or os.devnull)
+
+    images = []
+    if not args.no_bundled:
+        for name, (tech, filename) in bundledImages.items():
+            data = tiff.imread(os.path.join(folder, filename))
+            images.append((name, data) + headless.analysisArgs(config, tech))
+    for size in args.sizes:
+        stedArgs, corrThres = headless.analysisArgs(config, 'STED')
+        data = syntheticImage(size, stedArgs[0])
+        images.append(('synthetic{}'.format(size), data, stedArgs, corrThres))
+
+    results = []
+    for name, data, imageArgs, corrThres in images:
+        sys.stderr.write('Benchmarking ' + name + '\n')
+        results.extend(benchImage(name, data, imageArgs, args.thsteps,
+                                  args.workers, args.repeat, args.files,
+                                  corrThres=corrThres))
+
+    with open(args.output, 'w') as f:
+        json.dump({'machine': machine(), 'date': time.strftime('%Y-%m-%d %X'),
+                   'results': results}, f, indent=1)
+
+    baseline = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    nslower = compare(results, baseline, args.tolerance)
+    return 1 if nslower > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
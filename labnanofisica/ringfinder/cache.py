@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+class ResultCache:
+    """On-disk cache of the ring finder results of whole images. Each entry
+    holds the correlation, angle and phase of every block of an image and is
+    addressed by a hash of the image data and every analysis parameter the
+    results depend on. The discrimination threshold isn't one of them, so
+    it can be changed without analyzing again.
+
+    When the files in the folder take more than maxSize bytes, the least
+    recently used ones are removed.
+
+    folder: directory where the results are saved
+    maxSize: maximum size of the cache in bytes"""
+
+    def __init__(self, folder, maxSize=500*2**20):
+        self.folder = folder
+        self.maxSize = maxSize
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(data, n, pxSize, crop, gaussSigma, intThr, cArgs, bandThres,
+            dirMethod, adaptive=(), decisionThres=None, phaseMethod='scan',
+            thetaMethod='grid'):
+        """Hash of the image and the analysis parameters.
+
+        data: input image, already cropped. Its precision is part of the key.
+        n: number of blocks along each axis
+        pxSize, crop: pixel size in nm and cropped pixels
+        gaussSigma: sigma of the gaussian filter in nm
+        intThr: intensity threshold
+        cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod
+        bandThres: band power threshold of tools.corrBlock
+        dirMethod: neurite direction method, 'tensor' or 'hough'
+        adaptive: levels, corrThres and margin of the adaptive analysis (see
+            quadtree.analyzeAdaptive), empty if every block is analyzed
+        decisionThres: discrimination threshold of the decision mode (see
+            tools.corrDecision), None if the blocks are fully correlated
+        phaseMethod, thetaMethod: phase and angle methods of
+            tools.corrMethod"""
+
+        h = hashlib.sha1(np.dtype(data.dtype).name.encode())
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        params = np.concatenate((data.shape, n, [pxSize, crop, gaussSigma,
+                                                 intThr, bandThres], cArgs,
+                                 adaptive))
+        if decisionThres is not None:
+            # The correlation of the blocks without rings depends on it
+            params = np.append(params, decisionThres)
+        # Rounding so values that only differ in float representation share
+        # the same results
+        params = np.round(np.array(params, dtype=np.float64), 9)
+
+        h.update(data.tobytes())
+        h.update(params.tobytes())
+        h.update(dirMethod.encode())
+        # Keys of the default methods are the same as before they were added
+        if phaseMethod != 'scan':
+            h.update(phaseMethod.encode())
+        if thetaMethod != 'grid':
+            h.update(thetaMethod.encode())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def get(self, key):
+        """Cached (localCorr, theta, phase) arrays, None if not in cache."""
+
+        filename = self.filename(key)
+        try:
+            with np.load(filename) as f:
+                result = f['corr'], f['theta'], f['phase']
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # The access time is kept in the modification time, so it's used for
+        # the eviction even in filesystems mounted with noatime
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        return result
+
+    def put(self, key, corr, theta, phase):
+
+        # The entry is written to a temporary file that replaces the final one
+        # when complete, so other processes never read half written results
+        fd, tmpName = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, corr=corr, theta=theta, phase=phase)
+        os.replace(tmpName, self.filename(key))
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache size is
+        within maxSize."""
+
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                except OSError:
+                    # removed by another process
+                    pass
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.folder, name))
+
+
+def fromConfig(perfConfig):
+    """Cache set in the performance section of the config file, None if it's
+    disabled (size 0, the default). Without a folder, the results are kept in
+    ~/.ringfinder_cache."""
+
+    maxSize = perfConfig.getfloat('Cache size MB')*2**20
+    if maxSize <= 0:
+        return None
+
+    folder = perfConfig.get('Cache folder')
+    if folder == '':
+        folder = os.path.join(os.path.expanduser('~'), '.ringfinder_cache')
+
+    return ResultCache(folder, maxSize)
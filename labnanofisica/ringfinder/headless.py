@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Ring finder batch analysis from the command line, without Qt nor dialogs. The
+analysis settings are read from the config file of the GUI, for example
+
+    python bin/ringFinderBatch.py STED /data/day1 "/data/day2/*_ctrl.tif"
+
+Each folder is analyzed as a batch of the GUI: it gets the results of every
+block of every file in a hdf5 store (see store.py), the _correlation and _rings
+images of every file unless --no-images is given, the corr_values table and
+corr_hist plot. With
+--timing, the time spent in every stage of the analysis is reported and saved
+in a timing.json file of each folder. With
+--adaptive, blocks are correlated in groups that are only split where the
+result is ambiguous (see quadtree.py). With
+--decision, blocks are only correlated until it's known whether they have
+rings (see tools.corrDecision). With
+--slide, every file is a large image that is analyzed tile by tile (see
+slide.py) and its results are saved at block resolution. With
+--dense, every window of the block size is correlated, every --stride
+pixels, and each file gets a _corrmap image (see tools.corrMap).
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+from collections import OrderedDict
+import numpy as np
+import tifffile as tiff
+
+import matplotlib
+matplotlib.use('Agg')
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.pipeline as pipeline
+import labnanofisica.ringfinder.cache as cache
+import labnanofisica.ringfinder.templates as templates
+import labnanofisica.ringfinder.slide as slide
+from labnanofisica.ringfinder.timing import timer, timingName
+
+# Images written by the analysis, they're not analyzed again
+outputSuffixes = ('_correlation', '_rings', '_correlation_grid', '_corrmap')
+
+
+def isOutput(filename):
+    name = os.path.splitext(filename)[0]
+    return name.endswith(outputSuffixes)
+
+
+def findFiles(inputs):
+    """Tiff files (.tif or .tiff) of the given folders or glob patterns,
+    grouped by folder.
+
+    returns an OrderedDict folder -> sorted filenames"""
+
+    folders = OrderedDict()
+    for item in inputs:
+        if os.path.isdir(item):
+            # .tif and .tiff files, in any case
+            files = glob.glob(os.path.join(item, '*'))
+        else:
+            files = glob.glob(item)
+
+        for f in sorted(files):
+            if f.lower().endswith(('.tif', '.tiff')) and not isOutput(f):
+                path = os.path.split(os.path.abspath(f))[0]
+                folders.setdefault(path, [])
+                if f not in folders[path]:
+                    folders[path].append(f)
+
+    return folders
+
+
+def analysisArgs(config, tech):
+    """Pipeline arguments and discrimination threshold from the config file,
+    the same way the GUI reads them from its fields."""
+
+    loadConfig = config['Loading']
+    analysisConfig = config['Analysis']
+
+    if tech == 'STORM':
+        pxSize = loadConfig.getfloat('STORM px nm')
+        crop = int(3*loadConfig.getfloat('STORM magnification'))
+    else:
+        pxSize = loadConfig.getfloat('STED px nm')
+        crop = 0
+
+    gaussSigma = analysisConfig.getfloat('Gaussian sigma filter nm')
+    intThr = analysisConfig.getfloat('nsigmas threshold')
+    minLen = analysisConfig.getfloat('Lines min length nm')/pxSize
+    thetaStep = analysisConfig.getfloat('Angular step deg')
+    deltaTh = analysisConfig.getfloat('Delta angle deg')
+    wvlen = analysisConfig.getfloat('Ring periodicity nm')/pxSize
+    sinPow = analysisConfig.getfloat('Sinusoidal pattern power')
+    corrThres = analysisConfig.getfloat('Discrimination threshold')
+    cArgs = minLen, thetaStep, deltaTh, wvlen, sinPow
+
+    return (pxSize, crop, gaussSigma, intThr, cArgs), corrThres
+
+
+class Progress:
+    """Reports the throughput and the estimated remaining time of the analysis
+    to stderr, at most every interval seconds."""
+
+    def __init__(self, nfiles, interval=10, stream=sys.stderr, unit='files'):
+        self.nfiles = nfiles
+        self.interval = interval
+        self.stream = stream
+        self.unit = unit
+        self.ndone = 0
+        self.t0 = time.time()
+        self.lastReport = self.t0
+
+    def update(self, nblocks):
+        self.ndone += 1
+        now = time.time()
+        if now - self.lastReport >= self.interval or self.ndone == self.nfiles:
+            self.lastReport = now
+            elapsed = now - self.t0
+            rate = self.ndone/elapsed
+            eta = (self.nfiles - self.ndone)/rate
+            text = ('{0}/{1} {5}, {2:.2f} {5}/s, {3:.0f} blocks/s, '
+                    'ETA {4:.0f} s\n')
+            self.stream.write(text.format(self.ndone, self.nfiles, rate,
+                                          nblocks*rate, eta, self.unit))
+            self.stream.flush()
+
+
+def analyzeFolders(folders, tech, config, nworkers=None, interval=10,
+                   useCache=True, checkPrecision=False, exportImages=None,
+                   timing=None, levels=None, decision=None,
+                   templateBank=None):
+    """Analyzes every folder (see findFiles) as a batch. Images whose results
+    are in the cache of the config file aren't analyzed again, unless
+    useCache is False. With checkPrecision, the first image of each folder is
+    also analyzed in double and single precision to report their difference.
+    exportImages, timing, levels, decision and templateBank override the
+    'Export images', 'Timing', 'Adaptive levels', 'Decision mode' and
+    'Template bank' settings of the config file.
+
+    returns a dict folder -> (ringFrac, ringStd)"""
+
+    args, corrThres = analysisArgs(config, tech)
+    perfConfig = config['Performance']
+    if nworkers is None:
+        nworkers = perfConfig.getint('Worker processes')
+    bandThres = perfConfig.getfloat('Band power threshold')
+    resultCache = cache.fromConfig(perfConfig) if useCache else None
+    dirMethod = perfConfig.get('Direction method')
+    phaseMethod = perfConfig.get('Phase method')
+    thetaMethod = perfConfig.get('Angle method')
+    dtype = tools.computeDtype(perfConfig)
+    if exportImages is None:
+        exportImages = perfConfig.getboolean('Export images')
+    if timing is None:
+        timing = perfConfig.getboolean('Timing')
+    timer.enable(timing)
+    if levels is None:
+        levels = perfConfig.getint('Adaptive levels')
+    margin = perfConfig.getfloat('Adaptive margin')
+    if decision is None:
+        decision = perfConfig.getboolean('Decision mode')
+    templates.fromConfig(perfConfig, templateBank)
+
+    progress = Progress(sum(len(f) for f in folders.values()), interval)
+    results = OrderedDict()
+    for path, files in folders.items():
+        sys.stderr.write('Processing folder ' + path + '\n')
+        t0 = time.time()
+        timer.reset()
+
+        batch = pipeline.Pipeline(files, *args, nworkers=nworkers,
+                                  bandThres=bandThres, cache=resultCache,
+                                  dirMethod=dirMethod, dtype=dtype,
+                                  exportImages=exportImages, levels=levels,
+                                  corrThres=corrThres, margin=margin,
+                                  decision=decision, phaseMethod=phaseMethod,
+                                  thetaMethod=thetaMethod)
+        nblocks = batch.n[0]*batch.n[1]
+
+        if checkPrecision:
+            data = batch.decode(files[0])
+            data = data[batch.crop:batch.bound[0], batch.crop:batch.bound[1]]
+            maxDev, nDiffer = pipeline.validatePrecision(
+                data, batch.gaussSigma, batch.intThres, batch.nblocks,
+                batch.cArgs, bandThres, dirMethod, phaseMethod, thetaMethod)
+            text = ('Single precision: max correlation deviation {0:.2e}, '
+                    '{1} blocks discarded differently\n')
+            sys.stderr.write(text.format(maxDev, nDiffer))
+        corrArray = batch.run(done=lambda i, c: progress.update(nblocks))
+        batch.saveRings(corrThres)
+        batch.close()
+        results[path] = pipeline.saveSummary(path, corrArray, corrThres)
+
+        text = 'Folder {0} done in {1:.0f} seconds, ringFrac={2:.3f}\n'
+        sys.stderr.write(text.format(os.path.split(path)[1], time.time() - t0,
+                                     results[path][0]))
+        if timing:
+            timer.summary(sys.stderr)
+            timer.dump(timingName(path))
+
+    return results
+
+
+def analyzeSlides(files, tech, config, nworkers=None, interval=10,
+                  tileBlocks=16):
+    """Analyzes every file as a large image, tile by tile, and saves its
+    _correlation_grid image and _grid.npz results (see slide.saveGrid).
+
+    returns a dict filename -> ringFrac"""
+
+    args, corrThres = analysisArgs(config, tech)
+    perfConfig = config['Performance']
+    if nworkers is None:
+        nworkers = perfConfig.getint('Worker processes')
+    bandThres = perfConfig.getfloat('Band power threshold')
+    dirMethod = perfConfig.get('Direction method')
+    phaseMethod = perfConfig.get('Phase method')
+    thetaMethod = perfConfig.get('Angle method')
+    dtype = tools.computeDtype(perfConfig)
+    pxSize, crop = args[:2]
+    nblocks = tileBlocks**2
+
+    results = OrderedDict()
+    for filename in files:
+        sys.stderr.write('Processing slide ' + filename + '\n')
+        t0 = time.time()
+
+        progress = None
+
+        def report(ndone, ntiles):
+            # The tile count is only known when the analysis starts
+            nonlocal progress
+            if ndone == 0:
+                progress = Progress(ntiles, interval, unit='tiles')
+            else:
+                progress.update(nblocks)
+
+        corr, theta, phase = slide.analyzeSlide(
+            filename, *args, tileBlocks=tileBlocks, nworkers=nworkers,
+            bandThres=bandThres, dirMethod=dirMethod, dtype=dtype,
+            progress=report, phaseMethod=phaseMethod,
+            thetaMethod=thetaMethod)
+        slide.saveGrid(filename, corr, theta, phase, pxSize, crop)
+
+        valid = corr[~np.isnan(corr)]
+        results[filename] = np.sum(valid > corrThres)/max(valid.size, 1)
+        text = 'Slide {0} done in {1:.0f} seconds, ringFrac={2:.3f}\n'
+        sys.stderr.write(text.format(os.path.split(filename)[1],
+                                     time.time() - t0, results[filename]))
+
+    return results
+
+
+def analyzeDense(files, tech, config, stride=5, interval=10):
+    """Correlates every window of the block size of every file, every stride
+    px (see pipeline.denseCorrelation), and saves its _corrmap image.
+
+    returns a dict filename -> fraction of windows with rings"""
+
+    args, corrThres = analysisArgs(config, tech)
+    pxSize, crop, gaussSigma, intThr, cArgs = args
+    dtype = tools.computeDtype(config['Performance'])
+    subImgSize = int(round(1000/pxSize))
+
+    progress = Progress(len(files), interval)
+    results = OrderedDict()
+    for filename in files:
+        data = tiff.imread(filename).astype(dtype)
+        data = data[crop:data.shape[0] - crop, crop:data.shape[1] - crop]
+        corr = pipeline.denseCorrelation(data, gaussSigma/pxSize, intThr,
+                                         subImgSize, cArgs, stride)[0]
+        pipeline.saveCorrMap(filename, corr, pxSize, stride)
+
+        valid = corr[~np.isnan(corr)]
+        results[filename] = np.sum(valid > corrThres)/max(valid.size, 1)
+        progress.update(corr.size)
+
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description='Ring finder analysis of folders of images.')
+    parser.add_argument('tech', choices=['STED', 'STORM'],
+                        help='technique the images were taken with')
+    parser.add_argument('inputs', nargs='+',
+                        help='folders or glob patterns of tiff images')
+    parser.add_argument('-c', '--config', default=None,
+                        help='config file, by default the one in the working '
+                             'directory')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes, 0 for one per '
+                             'core. Overrides the config file')
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help='seconds between progress reports')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="analyze all images, even if they're cached")
+    parser.add_argument('--check-precision', action='store_true',
+                        help='compare the single and double precision '
+                             'analysis of the first image of each folder')
+    parser.add_argument('--no-images', action='store_true',
+                        help="don't save the _correlation and _rings images, "
+                             'only the hdf5 store')
+    parser.add_argument('--slide', action='store_true',
+                        help='analyze each file as a large image, tile by '
+                             'tile, and save the results per block')
+    parser.add_argument('--tile-blocks', type=int, default=16,
+                        help='side of the tiles in blocks, with --slide')
+    parser.add_argument('--dense', action='store_true',
+                        help='correlate every window of the block size and '
+                             'save a _corrmap image of each file')
+    parser.add_argument('--stride', type=int, default=5,
+                        help='pixels between the windows, with --dense')
+    parser.add_argument('--adaptive', type=int, default=None,
+                        metavar='LEVELS',
+                        help='correlate nodes of 2**LEVELS x 2**LEVELS blocks '
+                             'and split only the ambiguous ones (see '
+                             'quadtree.py). Overrides the config file')
+    parser.add_argument('--decision', action='store_true',
+                        help='only correlate each block until it is known '
+                             'whether it has rings, see tools.corrDecision. '
+                             'Overrides the config file')
+    parser.add_argument('--template-bank', default=None, metavar='FILE',
+                        help='.npy file the simulated axons are saved to and '
+                             'read from in later runs. Overrides the config '
+                             'file')
+    parser.add_argument('--timing', action='store_true',
+                        help='report the time spent in every stage of the '
+                             'analysis and save it in a timing.json file')
+    args = parser.parse_args(argv)
+
+    folders = findFiles(args.inputs)
+    if len(folders) == 0:
+        parser.error('no tiff files found')
+
+    if args.config is not None and not os.path.exists(args.config):
+        parser.error('config file ' + args.config + ' not found')
+
+    config = tools.readConfig(args.config)
+    if args.slide:
+        files = [f for path in folders.values() for f in path]
+        analyzeSlides(files, args.tech, config, args.workers, args.interval,
+                      args.tile_blocks)
+        return
+
+    if args.dense:
+        files = [f for path in folders.values() for f in path]
+        analyzeDense(files, args.tech, config, args.stride, args.interval)
+        return
+
+    analyzeFolders(folders, args.tech, config, args.workers, args.interval,
+                   not args.no_cache, args.check_precision,
+                   False if args.no_images else None,
+                   True if args.timing else None, args.adaptive,
+                   True if args.decision else None, args.template_bank)
+
+
+if __name__ == '__main__':
+    main()
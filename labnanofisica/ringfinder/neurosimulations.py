@@ -78,3 +78,47 @@ class simAxon(sin2D):
 
         # Make simulated axon data
         self.data = self.grating2*(self.mask)
+
+
+def simAxonStack(imSize, wvlen, theta, phase, a=0, b=2):
+    """Data of simAxon for every set of wvlen, theta, phase and b, which are
+    broadcast against each other. All the templates are calculated at once,
+    sharing the coordinates, and with the same operations as sin2D so they're
+    identical to the ones of simAxon.
+
+    returns an array of shape (N, imSize, imSize)"""
+
+    wvlen, theta, phase, b = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(v, dtype=float))
+          for v in (wvlen, theta, phase, b)])
+    wvlen = np.where(b % 2 == 0, 2*wvlen, wvlen)
+
+    X0 = (np.arange(1, imSize + 1) / imSize) - .5
+    thetaRad = ((90 - theta) / 360) * 2*np.pi
+    cos = np.cos(thetaRad)[:, np.newaxis, np.newaxis]
+    sin = np.sin(thetaRad)[:, np.newaxis, np.newaxis]
+    phaseRad = (phase * 2*np.pi)[:, np.newaxis, np.newaxis]
+
+    def grating(freq, out):
+        # Xm varies along the columns and Ym along the rows
+        np.add(X0 * cos, X0[:, np.newaxis] * sin, out=out)
+        out *= freq[:, np.newaxis, np.newaxis]
+        out *= 2
+        out *= np.pi
+        out += phaseRad
+        return np.sin(out, out=out)
+
+    data = grating(imSize/wvlen, np.empty((len(theta), imSize, imSize)))
+    powers = np.unique(b)
+    if len(powers) == 1:
+        data **= powers[0]
+    else:
+        for i in np.arange(len(b)):
+            data[i] **= b[i]
+
+    # The mask is all ones for a=0
+    if a != 0:
+        freq = np.full(len(theta), imSize/(2*imSize))
+        data *= grating(freq, np.empty_like(data))**a
+
+    return data
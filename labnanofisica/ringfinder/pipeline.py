@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import queue
+import threading
+import multiprocessing as mp
+import numpy as np
+from scipy import ndimage as ndi
+from PIL import Image
+import tifffile as tiff
+import matplotlib.pyplot as plt
+
+import labnanofisica.utils as utils
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.store as store
+import labnanofisica.ringfinder.templates as templates
+import labnanofisica.ringfinder.quadtree as quadtree
+from labnanofisica.ringfinder.timing import timer
+
+
+def prepareImage(inputData, gaussSigma, intThres, nblocks, dirMethod='tensor'):
+    """Smoothing, binarization and splitting in blocks of the image.
+
+    gaussSigma: sigma of the gaussian filter in px
+    intThres: intensity threshold in units of the smoothed image's std
+    nblocks: block shape
+    dirMethod: see Pipeline
+
+    returns the blocks of the image, of the smoothed image and of the mask,
+    the intensity threshold for the smoothed blocks and the neurite direction
+    of every block (None if found later by the hough transform)"""
+
+    # The filter keeps the image precision, statistics are done in double
+    with timer.stage('smooth'):
+        inputDataS = ndi.gaussian_filter(inputData, gaussSigma)
+        meanS = np.mean(inputDataS, dtype=np.float64)
+        stdS = np.std(inputDataS, dtype=np.float64)
+
+    with timer.stage('blocks'):
+        # binarization of image
+        mask = inputDataS < meanS + intThres*stdS
+
+        # shape the data into the subimg that we need for the analysis
+        blocksInput = tools.blockshaped(inputData, *nblocks)
+        blocksInputS = tools.blockshaped(inputDataS, *nblocks)
+        blocksMask = tools.blockshaped(mask, *nblocks)
+        thres = (np.mean(blocksInputS, dtype=np.float64) +
+                 intThres*np.std(blocksInputS, dtype=np.float64))
+
+    if dirMethod == 'tensor':
+        with timer.stage('direction'):
+            directions = tools.blockDirections(inputDataS, *nblocks)[0]
+    else:
+        directions = None
+
+    return blocksInput, blocksInputS, blocksMask, thres, directions
+
+
+def validatePrecision(inputData, gaussSigma, intThres, nblocks, cArgs,
+                      bandThres=0, dirMethod='tensor', phaseMethod='scan',
+                      thetaMethod='grid'):
+    """Analyzes an image in double and single precision and compares the
+    results.
+
+    inputData: input image, already cropped
+    other arguments: see prepareImage and tools.corrBlocks
+
+    returns the maximum deviation of the single precision correlation and the
+    number of blocks that were discarded (nan) in only one of the analysis"""
+
+    corr = []
+    for dtype in [np.float64, np.float32]:
+        output = prepareImage(inputData.astype(dtype), gaussSigma, intThres,
+                              nblocks, dirMethod)
+        blocksInput, blocksInputS, blocksMask, thres, directions = output
+        corr.append(tools.corrBlocks(blocksInput, blocksInputS, blocksMask,
+                                     thres, cArgs, bandThres,
+                                     directions=directions,
+                                     phaseMethod=phaseMethod,
+                                     thetaMethod=thetaMethod)[0])
+
+    corr64, corr32 = corr
+    both = np.logical_and(~np.isnan(corr64), ~np.isnan(corr32))
+    maxDev = np.max(np.abs(corr64[both] - corr32[both]), initial=0)
+    nDiffer = np.sum(np.isnan(corr64) != np.isnan(corr32))
+
+    return maxDev, nDiffer
+
+
+def denseCorrelation(inputData, gaussSigma, intThres, subImgSize, cArgs,
+                     stride=1):
+    """Correlation of every subImgSize window of an image, every stride px,
+    see tools.corrMap. The mask is the binarization of prepareImage. Windows
+    have no neurite direction, so every angle from 0 to 180 deg is
+    correlated.
+
+    inputData: input image, already cropped
+    subImgSize: size of the windows in px
+    other arguments: see prepareImage and tools.corrMethod
+
+    returns the correlation, angle and phase of every window"""
+
+    minLen, thStep, deltaTh, wvlen, sinPow = cArgs
+    with timer.stage('smooth'):
+        inputDataS = ndi.gaussian_filter(inputData, gaussSigma)
+        mask = inputDataS < (np.mean(inputDataS, dtype=np.float64) +
+                             intThres*np.std(inputDataS, dtype=np.float64))
+
+    with timer.stage('corrMap'):
+        return tools.corrMap(inputData, mask, subImgSize, wvlen, sinPow,
+                             thStep, stride)
+
+
+def saveCorrMap(filename, corr, pxSize, stride):
+    """Saves the correlation of denseCorrelation to a _corrmap tiff, with one
+    pixel per window. Pixel [i, j] is the window that starts at pixel
+    [i*stride, j*stride] of the cropped image."""
+
+    stepUm = stride*pxSize/1000
+    tiff.imwrite(utils.insertSuffix(filename, '_corrmap'),
+                 corr.astype(np.single), software='Gollum', imagej=True,
+                 resolution=(1/stepUm, 1/stepUm),
+                 metadata={'spacing': 1, 'unit': 'um'})
+
+
+class Pipeline:
+    """Batch analysis of a set of images in three overlapping stages:
+
+    - prefetch: a thread decodes, filters and binarizes the next images
+    - compute: the blocks of each image are correlated by a pool of worker
+      processes (see tools.corrBlocks)
+    - write: a thread saves the results of the analyzed ones to a
+      store.ResultStore, and optionally their _correlation images
+
+    The stages communicate through bounded queues, so at most queueSize images
+    are waiting between two stages and the memory use doesn't grow with the
+    number of files.
+
+    files: filenames of the images, all of the same shape
+    pxSize: pixel size in nm
+    crop: number of pixels cropped from each border of the images
+    gaussSigma: sigma of the gaussian filter in nm
+    intThres: intensity threshold in units of the smoothed image's std
+    cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod
+    nworkers: number of worker processes, 0 means one for each CPU core
+    bandThres: band power threshold, see tools.corrBlock
+    queueSize: maximum number of images waiting between stages
+    cache: cache.ResultCache with the results of previously analyzed images,
+        they're not analyzed again
+    dirMethod: 'tensor' finds the neurite direction of all blocks at once
+        with tools.blockDirections, 'hough' one by one with getDirection
+    dtype: float type the images are analyzed with, see tools.computeDtype
+    storeFile: hdf5 file of the results, by default store.storeName of the
+        images' folder
+    exportImages: whether the full resolution _correlation and _rings images
+        are saved too
+    levels: levels of the adaptive analysis, at most quadtree.maxLevels (see
+        quadtree.analyzeAdaptive). With 0 every block is correlated.
+    corrThres, margin: discrimination threshold and margin of the adaptive
+        analysis
+    decision: whether blocks are only correlated until it's known if they
+        reach corrThres, see tools.corrDecision. Their correlation is then
+        the best one found, which is enough to tell the rings apart.
+    phaseMethod, thetaMethod: phase and angle methods of tools.corrMethod"""
+
+    def __init__(self, files, pxSize, crop, gaussSigma, intThres, cArgs,
+                 nworkers=0, bandThres=0, queueSize=2, cache=None,
+                 dirMethod='tensor', dtype=np.float64, storeFile=None,
+                 exportImages=True, levels=0, corrThres=None, margin=0.05,
+                 decision=False, phaseMethod='scan', thetaMethod='grid'):
+
+        self.files = files
+        self.pxSize = pxSize
+        self.crop = int(crop)
+        self.sigmaNm = gaussSigma
+        self.gaussSigma = gaussSigma/self.pxSize
+        self.intThres = intThres
+        self.cArgs = cArgs
+        self.bandThres = bandThres
+        self.queueSize = queueSize
+        self.cache = cache
+        self.dirMethod = dirMethod
+        self.dtype = dtype
+        self.exportImages = exportImages
+        levels = min(levels, quadtree.maxLevels(cArgs[3]))
+        self.levels = levels
+        self.corrThres = corrThres
+        self.margin = margin
+        if (levels > 0 or decision) and corrThres is None:
+            raise ValueError('The adaptive analysis and the decision mode '
+                             'need the discrimination threshold')
+        self.adaptive = (levels, corrThres, margin) if levels > 0 else ()
+        self.decisionThres = corrThres if decision else None
+        self.phaseMethod = phaseMethod
+        self.thetaMethod = thetaMethod
+
+        if nworkers == 0:
+            nworkers = mp.cpu_count()
+        self.nworkers = nworkers
+
+        self.nfiles = len(files)
+        self.subimgPxSize = 1000/self.pxSize
+
+        # Get data shape and derivates from the first image
+        inputData = self.decode(self.files[0])
+        self.initShape = inputData.shape
+        self.bound = (np.array(self.initShape) - self.crop).astype(int)
+        inputData = inputData[self.crop:self.bound[0], self.crop:self.bound[1]]
+        dataShape = inputData.shape
+        self.n = (np.array(dataShape)/self.subimgPxSize).astype(int)
+        self.mag = np.array(dataShape)/self.n
+        self.nblocks = np.array(dataShape)/self.n
+        self.path = os.path.split(self.files[0])[0]
+
+        # Only the correlation is kept in memory, for the summary
+        self.corrArray = np.zeros((self.nfiles, self.n[0], self.n[1]))
+        if storeFile is None:
+            storeFile = store.storeName(self.path)
+        self.store = store.ResultStore(storeFile, files, self.n, self.pxSize,
+                                       self.crop, self.initShape)
+
+        self.stopEvent = threading.Event()
+        self.error = None
+
+    def decode(self, filename):
+        im = Image.open(filename)
+        return np.array(im).astype(self.dtype)
+
+    def load(self, filename):
+        """Prefetch stage: image loading, and if its results aren't cached,
+        smoothing, binarization and splitting in blocks.
+
+        returns the cache key, the blocks (see prepare) and the cached
+        results. Only one of the last two is not None."""
+
+        timer.setFile(filename)
+        with timer.stage('decode'):
+            inputData = self.decode(filename)
+        inputData = inputData[self.crop:self.bound[0], self.crop:self.bound[1]]
+
+        key = None
+        if self.cache is not None:
+            with timer.stage('cache'):
+                key = self.cache.key(inputData, self.n, self.pxSize,
+                                     self.crop, self.sigmaNm, self.intThres,
+                                     self.cArgs, self.bandThres,
+                                     self.dirMethod, self.adaptive,
+                                     self.decisionThres, self.phaseMethod,
+                                     self.thetaMethod)
+                cached = self.cache.get(key)
+            if cached is not None:
+                return key, None, cached
+
+        return key, self.prepare(inputData), None
+
+    def prepare(self, inputData):
+        return prepareImage(inputData, self.gaussSigma, self.intThres,
+                            self.nblocks, self.dirMethod)
+
+    def save(self, i, key, localCorr, localTheta, localPhase):
+        """Write stage: results in the store, correlation values image and
+        cache entry."""
+
+        with timer.stage('write', self.files[i]):
+            self.store.write(i, localCorr, localTheta, localPhase)
+            if self.exportImages:
+                self.store.exportImages([i], rings=False)
+        if key is not None:
+            with timer.stage('cache', self.files[i]):
+                self.cache.put(key, localCorr, localTheta, localPhase)
+
+    def saveRings(self, corrThres):
+        """Flags the blocks with correlation over corrThres in the store and
+        saves the ring images of all analyzed files, see
+        store.ResultStore.exportImages."""
+
+        with timer.stage('rings'):
+            self.store.setRings(corrThres)
+            if self.exportImages:
+                self.store.exportImages(correlation=False)
+
+    def close(self):
+        self.store.close()
+
+    def put(self, q, item):
+        # Waiting for room in the queue unless the pipeline is stopped
+        while not self.stopEvent.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, q):
+        while not self.stopEvent.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def prefetchLoop(self, loadQueue):
+        try:
+            for i in np.arange(self.nfiles):
+                if self.stopEvent.is_set():
+                    return
+                self.put(loadQueue, (i, ) + self.load(self.files[i]))
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.put(loadQueue, None)
+
+    def writeLoop(self, writeQueue):
+        # The queue is always drained so the compute stage never blocks on it,
+        # even after an error
+        while True:
+            item = writeQueue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.save(*item)
+                except Exception as e:
+                    self.fail(e)
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stopEvent.set()
+
+    def stop(self):
+        """Stops the analysis after the image being analyzed. Images already
+        analyzed are still saved."""
+        self.stopEvent.set()
+
+    def run(self, started=None, done=None):
+        """Analyzes all files. started(i) is called when the blocks of the
+        i-th file start being correlated and done(i, localCorr) when they're
+        finished.
+
+        returns an array with the correlation of every block of every file"""
+
+        if templates.bank.filename is not None:
+            # The simulated axons of all blocks are saved to the bank's file
+            # once, and then every worker process reads them from it
+            with timer.stage('templates'):
+                if tools.fillBank(int(self.nblocks[0]), self.cArgs) > 0:
+                    templates.bank.save()
+
+        loadQueue = queue.Queue(self.queueSize)
+        writeQueue = queue.Queue(self.queueSize)
+        prefetcher = threading.Thread(target=self.prefetchLoop,
+                                      args=(loadQueue, ), daemon=True)
+        writer = threading.Thread(target=self.writeLoop, args=(writeQueue, ),
+                                  daemon=True)
+
+        # The pool is only started if some image isn't cached
+        pool = None
+        try:
+            prefetcher.start()
+            writer.start()
+            while True:
+                item = self.get(loadQueue)
+                if item is None:
+                    break
+                i, key, blocks, cached = item
+                timer.setFile(self.files[i])
+                if started is not None:
+                    started(i)
+
+                if cached is None:
+                    if pool is None and self.nworkers > 1:
+                        pool = tools.workerPool(self.nworkers)
+                    if self.levels > 0:
+                        with timer.stage('adaptive'):
+                            results = quadtree.analyzeAdaptive(
+                                blocks, self.n, self.cArgs, self.corrThres,
+                                self.levels, self.margin, self.bandThres,
+                                self.nworkers, pool, self.dirMethod,
+                                self.decisionThres is not None,
+                                self.phaseMethod,
+                                self.thetaMethod).rasterize()
+                    else:
+                        (blocksInput, blocksInputS, blocksMask, thres,
+                         directions) = blocks
+                        with timer.stage('corrBlocks'):
+                            results = tools.corrBlocks(
+                                blocksInput, blocksInputS, blocksMask, thres,
+                                self.cArgs, self.bandThres, self.nworkers,
+                                pool, directions,
+                                corrThres=self.decisionThres,
+                                phaseMethod=self.phaseMethod,
+                                thetaMethod=self.thetaMethod)
+                else:
+                    results = cached
+                    # Already in the cache
+                    key = None
+
+                localCorr, localTheta, localPhase = [r.reshape(*self.n)
+                                                     for r in results]
+                self.corrArray[i] = localCorr
+                if done is not None:
+                    done(i, localCorr)
+
+                writeQueue.put((i, key, localCorr, localTheta, localPhase))
+
+        except Exception as e:
+            self.fail(e)
+
+        finally:
+            writeQueue.put(None)
+            writer.join()
+            self.stopEvent.set()
+            prefetcher.join()
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.corrArray
+
+
+def saveSummary(path, corrArray, corrThres):
+    """Saves the correlation values of all blocks of a folder in a table
+    (value and file index) and their histogram.
+
+    path: folder of the analyzed files
+    corrArray: correlation of every block of every file
+    corrThres: discrimination threshold
+
+    returns the fraction of blocks with rings and its standard error"""
+
+    folder = os.path.split(path)[1]
+    nfiles = len(corrArray)
+    nperFile = np.prod(corrArray.shape[1:])
+
+    # Save data array as txt
+    corrArrayFlat = corrArray.flatten()
+    validCorr = corrArrayFlat[~np.isnan(corrArrayFlat)]
+    validArr = np.repeat(np.arange(nfiles), nperFile)
+    validArr = validArr[~np.isnan(corrArrayFlat)]
+    valuesTxt = os.path.join(path, folder + 'corr_values.txt')
+    np.savetxt(valuesTxt, np.stack((validCorr, validArr), 1), fmt='%f\t%i')
+
+    # histogram of the correlation values
+    hrange = (np.min(np.nan_to_num(corrArray)),
+              np.max(np.nan_to_num(corrArray)))
+    y, x = np.histogram(validCorr, bins=60, range=hrange)
+    x = (x[1:] + x[:-1])/2
+
+    # Plotting
+    fig = plt.figure()
+    ringData = validCorr[validCorr > corrThres]
+    n = corrArray.size - np.count_nonzero(np.isnan(corrArray))
+    nring = np.sum(validCorr > corrThres)
+    ringFrac = nring / n
+    ringStd = math.sqrt(ringFrac*(1 - ringFrac)/n)
+    plt.bar(x, y, align='center', width=(x[1] - x[0]))
+    plt.plot((corrThres, corrThres), (0, np.max(y)), 'r--', linewidth=2)
+    text = ('ringFrac={0:.3f} +- {1:.3f} \n'
+            'correlation threshold={2:.2f} \n'
+            'mean correlation={3:.4f} +- {4:.4f} \n'
+            'mean ring correlation={5:.4f} +- {6:.4f}')
+    text = text.format(ringFrac, ringStd, corrThres,
+                       np.mean(validCorr), np.std(validCorr)/n,
+                       np.mean(ringData), np.std(ringData)/nring)
+    plt.text(0.8*plt.axis()[1], 0.8*plt.axis()[3], text,
+             horizontalalignment='center', verticalalignment='center',
+             bbox=dict(facecolor='white'))
+    plt.title("Correlations Histogram")
+    plt.xlabel("Value")
+    plt.ylabel("Frequency")
+    plt.savefig(os.path.join(path, folder + 'corr_hist.png'))
+    plt.close(fig)
+
+    return ringFrac, ringStd
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive analysis of the blocks of an image. Instead of correlating every
+block of the grid, the image is covered with nodes of 2**levels x 2**levels
+blocks that are only subdivided where their result is ambiguous:
+
+- nodes without any block that passes the discrimination are background
+- nodes whose blocks all pass it, with a clear and common neurite direction,
+  are correlated as a whole. If the node is clearly below the discrimination
+  threshold (by more than a margin), its blocks are bounded with
+  tools.corrBound: the ones whose bound is below the threshold can't have
+  rings and get a correlation of 0, like the blocks without the rings' band
+  power in tools.corrBlock, and the rest are correlated.
+- all the other nodes are split in four, down to single blocks, which are
+  analyzed exactly as in tools.corrBlocks
+
+The correlation of a node only decides how its blocks are analyzed, and the
+rings are always the same ones of the full analysis. A node of s x s blocks
+is correlated with one of every s x s pixels, which is the pearson
+correlation of the whole node with its simulated axon over a regular subset
+of its pixels, so it takes the same time as a single block. The pattern of
+these pixels is s times shorter, so there are only as many levels as the
+sampling limit allows (see maxLevels). The results are kept in a QuadTree
+that is rasterized to the usual grid.
+"""
+
+import numpy as np
+
+import labnanofisica.ringfinder.tools as tools
+
+
+class QuadTree:
+    """Sparse results of the adaptive analysis. The leaf (level, i, j) covers
+    blocks [i*2**level:(i + 1)*2**level, j*2**level:(j + 1)*2**level] of the
+    grid (clipped to it), all of them with the leaf's correlation, angle and
+    phase.
+
+    n: number of blocks along each axis
+    levels: level of the largest nodes"""
+
+    def __init__(self, n, levels):
+        self.n = tuple(int(v) for v in n)
+        self.levels = int(levels)
+        self.leaves = []
+
+        # Number of nodes that were correlated at each level, and of blocks
+        # that weren't because of their bound
+        self.correlated = np.zeros(self.levels + 1, dtype=int)
+        self.pruned = 0
+
+    def add(self, level, i, j, result):
+        self.leaves.append((level, i, j) + tuple(result))
+
+    def leafCount(self):
+        """Number of leaves of each level."""
+        count = np.zeros(self.levels + 1, dtype=int)
+        for leaf in self.leaves:
+            count[leaf[0]] += 1
+        return count
+
+    def rasterize(self):
+        """Correlation, angle and phase of every block of the grid, as given
+        by tools.corrBlocks but with shape n."""
+
+        results = np.zeros((3, ) + self.n)
+        results[:] = np.nan
+        for level, i, j, corr, theta, phase in self.leaves:
+            size = 2**level
+            results[:, i*size:(i + 1)*size, j*size:(j + 1)*size] = np.array(
+                [corr, theta, phase])[:, np.newaxis, np.newaxis]
+
+        return tuple(results)
+
+
+def nodeSamples(blocks, n, size, nodes):
+    """One of every size x size pixels of the nodes of size x size blocks of
+    the image, as an array of shape (len(nodes), h, w). The pixels are the
+    ones a simulated axon of the block size samples from the axon of the node
+    size (see neurosimulations.sin2D): the last one of every size x size
+    square.
+
+    blocks: array of shape (nblocks, h, w), as returned by blockshaped
+    n: number of blocks along each axis
+    nodes: (i, j) indices of complete nodes"""
+
+    h, w = blocks.shape[1:]
+    grid = blocks.reshape(n[0], n[1], h, w)
+    samples = np.zeros((len(nodes), h, w), dtype=blocks.dtype)
+    for k, (i, j) in enumerate(nodes):
+        node = grid[i*size:(i + 1)*size, j*size:(j + 1)*size]
+        node = node.swapaxes(1, 2).reshape(size*h, size*w)
+        samples[k] = node[size - 1::size, size - 1::size]
+
+    return samples
+
+
+def maxLevels(wvlen):
+    """Largest number of levels whose nodes sample the pattern above the
+    sampling limit, wvlen/2**levels > 2.
+
+    wvlen: wavelength of the ring pattern in px"""
+
+    levels = 0
+    while wvlen/2**(levels + 1) > 2:
+        levels += 1
+
+    return levels
+
+
+def blockBound(block, mask, direction, cArgs):
+    """Upper bound of the correlation of a block with the simulated axons of
+    every angle corrMethod correlates it with, see tools.corrBound.
+
+    direction: neurite direction of the block
+    cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod"""
+
+    minLen, thStep, deltaTh, wvlen, sinPow = cArgs
+    neuronFrac = 1 - np.sum(mask)/np.size(mask)
+    theta = tools.angleGrid(direction, thStep, deltaTh)
+    bound = tools.corrBound(block, mask, theta, wvlen, sinPow)
+
+    return np.max(bound)*neuronFrac
+
+
+def analyzeAdaptive(blocks, n, cArgs, corrThres, levels=2, margin=0.05,
+                    bandThres=0, nworkers=1, pool=None, dirMethod='tensor',
+                    decision=False, phaseMethod='scan', thetaMethod='grid'):
+    """Adaptive analysis of the blocks of an image, see the module docstring.
+
+    blocks: blocks of the image, of the smoothed image and of the mask, the
+        intensity threshold and the block directions, as returned by
+        pipeline.prepareImage
+    n: number of blocks along each axis
+    cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod
+    corrThres: discrimination threshold of the correlation
+    levels: the largest nodes have 2**levels x 2**levels blocks, at most
+        maxLevels(wvlen). With 0 every block is analyzed.
+    margin: only the nodes with a correlation below corrThres - margin have
+        their blocks bounded, the rest are split
+    bandThres, nworkers, pool: see tools.corrBlocks
+    dirMethod: 'tensor' or 'hough', see pipeline.Pipeline. Blocks need their
+        direction to be bounded, so with 'hough' the nodes aren't correlated
+        and only the background is skipped.
+    decision: whether single blocks are analyzed in decision mode, see
+        tools.corrDecision
+    phaseMethod: see tools.corrMethod. The bound of the blocks holds for any
+        phase, so it holds for both methods.
+    thetaMethod: see tools.corrMethod. The bound only holds for the angles of
+        the grid, so with 'adaptive' the nodes aren't correlated either.
+
+    returns a QuadTree with the results"""
+
+    blocksInput, blocksInputS, blocksMask, thres, directions = blocks
+    minLen, thStep, deltaTh, wvlen, sinPow = cArgs
+    n = tuple(int(v) for v in n)
+    h, w = blocksInput.shape[1:]
+    levels = min(levels, maxLevels(wvlen))
+    tree = QuadTree(n, levels)
+
+    # Block discrimination, see tools.corrBlock
+    neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+    gate = np.logical_and(np.any(blocksInputS > thres, (1, 2)),
+                          neuronFrac > 0.25).reshape(n)
+
+    # Whether the blocks of the nodes can be bounded
+    bounds = dirMethod == 'tensor' and thetaMethod == 'grid'
+
+    if bounds and levels > 0:
+        # The tensor of a node is the sum of the ones of its blocks
+        imageS = blocksInputS.reshape(n[0], n[1], h, w).swapaxes(1, 2)
+        imageS = imageS.reshape(n[0]*h, n[1]*w)
+        tensor = np.array(tools.blockTensor(imageS, h, w)).reshape(3, *n)
+        dirGrid = directions.reshape(n)
+
+    size = 2**levels
+    pending = [(i, j) for i in np.arange(-(-n[0]//size))
+               for j in np.arange(-(-n[1]//size))]
+
+    # Blocks of the nodes below the threshold
+    bounded = []
+
+    for level in np.arange(levels, 0, -1):
+        size = 2**level
+        nodes = []
+        children = []
+        for i, j in pending:
+            nodeGate = gate[i*size:(i + 1)*size, j*size:(j + 1)*size]
+            if not np.any(nodeGate):
+                tree.add(level, i, j, (np.nan, np.nan, np.nan))
+            elif (bounds and nodeGate.shape == (size, size)
+                  and np.all(nodeGate)):
+                nodes.append((i, j))
+            else:
+                children.extend(split(i, j, n, size))
+
+        if len(nodes) > 0:
+            # Tensor of every complete node of this level
+            rows, cols = n[0]//size, n[1]//size
+            nodeTensor = tensor[:, :rows*size, :cols*size].reshape(
+                3, rows, size, cols, size).sum((2, 4))
+            i, j = np.array(nodes).T
+            nodeDirections = tools.tensorDirections(*nodeTensor[:, i, j])[0]
+
+            # Nodes whose blocks aren't all along the node's direction are
+            # split without being correlated
+            common = [coherent(dirGrid[i*size:(i + 1)*size,
+                                       j*size:(j + 1)*size], th0, deltaTh)
+                      for (i, j), th0 in zip(nodes, nodeDirections)]
+            for (i, j), c in zip(nodes, common):
+                if not c:
+                    children.extend(split(i, j, n, size))
+            nodes = [node for node, c in zip(nodes, common) if c]
+            nodeDirections = nodeDirections[np.array(common, dtype=bool)]
+
+        if len(nodes) > 0:
+            # The pattern of the sampled pixels is size times shorter
+            nodeArgs = (minLen/size, thStep, deltaTh, wvlen/size, sinPow)
+            results = tools.corrBlocks(
+                nodeSamples(blocksInput, n, size, nodes),
+                nodeSamples(blocksInputS, n, size, nodes),
+                nodeSamples(blocksMask, n, size, nodes), thres, nodeArgs,
+                bandThres, nworkers, pool, nodeDirections,
+                phaseMethod=phaseMethod)
+            tree.correlated[level] += len(nodes)
+
+            for k, (i, j) in enumerate(nodes):
+                # nan, which is never below the threshold, is split too
+                if results[0][k] < corrThres - margin:
+                    bounded.extend((a, b)
+                                   for a in np.arange(i*size, (i + 1)*size)
+                                   for b in np.arange(j*size, (j + 1)*size))
+                else:
+                    children.extend(split(i, j, n, size))
+
+        pending = children
+
+    # Blocks that can't reach the threshold aren't correlated
+    for i, j in bounded:
+        ix = i*n[1] + j
+        if blockBound(blocksInput[ix], blocksMask[ix], directions[ix],
+                      cArgs) < corrThres:
+            tree.add(0, i, j, (0, np.nan, np.nan))
+            tree.pruned += 1
+        else:
+            pending.append((i, j))
+
+    # Single blocks, analyzed as in the full grid
+    for i, j in pending:
+        if not gate[i, j]:
+            tree.add(0, i, j, (np.nan, np.nan, np.nan))
+    pending = [(i, j) for i, j in pending if gate[i, j]]
+    if len(pending) > 0:
+        ix = np.array([i*n[1] + j for i, j in pending])
+        results = tools.corrBlocks(
+            blocksInput[ix], blocksInputS[ix], blocksMask[ix], thres, cArgs,
+            bandThres, nworkers, pool,
+            None if directions is None else directions[ix],
+            corrThres=corrThres if decision else None,
+            phaseMethod=phaseMethod, thetaMethod=thetaMethod)
+        tree.correlated[0] += len(ix)
+        for k, (i, j) in enumerate(pending):
+            tree.add(0, i, j, [r[k] for r in results])
+
+    return tree
+
+
+def coherent(blockDirections, th0, deltaTh):
+    """Whether all the block directions are within deltaTh/2 of the node's
+    direction th0, in deg."""
+
+    if np.isnan(th0) or np.any(np.isnan(blockDirections)):
+        return False
+    diff = np.abs(np.mod(blockDirections - th0 + 90, 180) - 90)
+    return bool(np.all(diff < deltaTh/2))
+
+
+def split(i, j, n, size):
+    """Children of node (i, j) of size x size blocks that are within the
+    grid."""
+
+    half = size//2
+    return [(2*i + di, 2*j + dj) for di in (0, 1) for dj in (0, 1)
+            if (2*i + di)*half < n[0] and (2*j + dj)*half < n[1]]
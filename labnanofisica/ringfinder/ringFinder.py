@@ -6,11 +6,11 @@ Created on Fri Jul 15 12:25:40 2016
 """
 
 import os
+import sys
 import time
-import math
+import threading
+import multiprocessing as mp
 import numpy as np
-from scipy import ndimage as ndi
-import tifffile as tiff
 from PIL import Image
 import matplotlib.pyplot as plt
 import pyqtgraph as pg
@@ -18,6 +18,13 @@ from pyqtgraph.Qt import QtGui, QtCore
 
 import labnanofisica.utils as utils
 import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.widgets as widgets
+import labnanofisica.ringfinder.pipeline as pipeline
+import labnanofisica.ringfinder.cache as cache
+import labnanofisica.ringfinder.stages as stages
+import labnanofisica.ringfinder.store as store
+import labnanofisica.ringfinder.templates as templates
+from labnanofisica.ringfinder.timing import timer, timingName
 
 
 class Gollum(QtGui.QMainWindow):
@@ -27,6 +34,17 @@ class Gollum(QtGui.QMainWindow):
 
         self.i = 0
 
+        # Analysis stages are only calculated again when their parameters
+        # change
+        self.analysis = stages.StagedAnalysis()
+        self.worker = None
+        self.workerThread = None
+
+        # Worker processes of the correlation, started when first needed and
+        # shared by every analysis of the window (see workerPool)
+        self.pool = None
+        self.poolArgs = None
+
         self.setWindowTitle('Gollum: the Ring Finder')
 
         self.cwidget = QtGui.QWidget()
@@ -127,6 +145,9 @@ class Gollum(QtGui.QMainWindow):
         self.sinPowerEdit = QtGui.QLineEdit()
         self.corrButton = QtGui.QPushButton('Run analysis')
         self.corrButton.setCheckable(True)
+        self.cancelButton = QtGui.QPushButton('Cancel')
+        self.cancelButton.setShortcut('Esc')
+        self.cancelButton.setEnabled(False)
         settingsFrame = QtGui.QFrame(self)
         settingsFrame.setFrameStyle(QtGui.QFrame.Panel)
         settingsLayout = QtGui.QGridLayout()
@@ -144,8 +165,9 @@ class Gollum(QtGui.QMainWindow):
         settingsLayout.addWidget(self.corrSlider, 3, 0, 1, 2)
         settingsLayout.addWidget(self.showCorrMapCheck, 4, 0, 1, 2)
         settingsLayout.addWidget(self.corrButton, 5, 0, 1, 2)
+        settingsLayout.addWidget(self.cancelButton, 6, 0, 1, 2)
         loadLayout.setColumnMinimumWidth(1, 40)
-        settingsFrame.setFixedHeight(180)
+        settingsFrame.setFixedHeight(210)
 
         # Load settings configuration and then connect the update
         try:
@@ -188,8 +210,8 @@ class Gollum(QtGui.QMainWindow):
 
         self.loadSTORMButton.clicked.connect(self.loadSTORM)
         self.loadSTEDButton.clicked.connect(self.loadSTED)
-        self.sigmaEdit.textChanged.connect(self.updateImage)
         self.corrButton.clicked.connect(self.ringFinder)
+        self.cancelButton.clicked.connect(self.cancelAnalysis)
 
         # Load sample STED image
         folder = os.path.join(os.getcwd(), 'labnanofisica', 'ringfinder')
@@ -209,9 +231,7 @@ class Gollum(QtGui.QMainWindow):
         self.corrSlider.setValue(1000*float(text))
         if self.analyzed:
             self.corrThres = float(text)
-            self.ringsBig = np.nan_to_num(self.localCorrBig) > self.corrThres
-            self.ringsBig = self.ringsBig.astype(float)
-            self.ringResult.setImage(np.fliplr(np.transpose(self.ringsBig)))
+            self.updateRings()
 
     def loadSTED(self, filename=None):
         load = self.loadImage(np.float(self.STEDPxEdit.text()), 'STED',
@@ -247,6 +267,7 @@ class Gollum(QtGui.QMainWindow):
 
             if self.filename is not None:
 
+                self.stopAnalysis()
                 self.corrButton.setChecked(False)
                 self.analyzed = False
 
@@ -258,14 +279,15 @@ class Gollum(QtGui.QMainWindow):
                 self.ringVb.clear()
                 self.ringResult.clear()
 
+                # Images are analyzed in the precision set in the config
+                dtype = tools.computeDtype(tools.loadPerformanceConfig())
                 im = Image.open(self.filename)
-                self.inputData = np.array(im).astype(np.float64)
+                self.inputData = np.array(im).astype(dtype)
                 self.initShape = self.inputData.shape
                 bound = (np.array(self.initShape) - self.crop).astype(np.int)
                 self.inputData = self.inputData[self.crop:bound[0],
                                                 self.crop:bound[1]]
                 self.shape = self.inputData.shape
-                self.updateImage()
                 self.corrVb.addItem(self.corrImgItem)
                 self.ringVb.addItem(self.ringImgItem)
                 showIm = np.fliplr(np.transpose(self.inputData))
@@ -275,7 +297,14 @@ class Gollum(QtGui.QMainWindow):
                 # We need 1um n-sized subimages
                 self.subimgPxSize = 1000/self.pxSize
                 self.n = (np.array(self.shape)/self.subimgPxSize).astype(int)
-                self.grid = tools.Grid(self.corrVb, self.shape, self.n)
+                self.analysis.setImage(self.inputData, self.n)
+                self.grid = widgets.Grid(self.corrVb, self.shape, self.n)
+
+                # Results are shown at block resolution, scaled to the image
+                mag = np.array(self.shape)/self.n
+                blockTransform = QtGui.QTransform.fromScale(mag[1], mag[0])
+                self.corrResult.setTransform(blockTransform)
+                self.ringResult.setTransform(blockTransform)
 
                 self.corrVb.setLimits(xMin=-0.05*self.shape[0],
                                       xMax=1.05*self.shape[0], minXRange=4,
@@ -301,17 +330,17 @@ class Gollum(QtGui.QMainWindow):
             self.fileStatus.setText('No file selected!')
 
     def updateImage(self):
+        # Smoothing and binarization are only calculated again if sigma or the
+        # threshold changed
         self.gaussSigma = np.float(self.sigmaEdit.text())/self.pxSize
-        self.inputDataS = ndi.gaussian_filter(self.inputData,
-                                              self.gaussSigma)
-        self.meanS = np.mean(self.inputDataS)
-        self.stdS = np.std(self.inputDataS)
+        output = self.analysis.smooth(self.gaussSigma)
+        self.inputDataS, self.meanS, self.stdS = output
 
         self.showImS = np.fliplr(np.transpose(self.inputDataS))
 
         # binarization of image
         thr = np.float(self.intThresEdit.text())
-        self.mask = self.inputDataS < self.meanS + thr*self.stdS
+        self.mask = self.analysis.mask(self.gaussSigma, thr)
         self.showMask = np.fliplr(np.transpose(self.mask))
 
     def ringFinder(self, show=True, batch=False):
@@ -319,16 +348,14 @@ class Gollum(QtGui.QMainWindow):
         using the given algorithm which decides if there are rings or not.
         Subsequently gives the output data and plots it"""
 
+        # A running analysis is superseded by the new one
+        self.stopAnalysis()
+
         if self.corrButton.isChecked() or batch:
 
             self.corrResult.clear()
             self.ringResult.clear()
-
-            # shape the data into the subimg that we need for the analysis
-            nblocks = np.array(self.inputData.shape)/self.n
-            blocksInput = tools.blockshaped(self.inputData, *nblocks)
-            blocksInputS = tools.blockshaped(self.inputDataS, *nblocks)
-            blocksMask = tools.blockshaped(self.mask, *nblocks)
+            self.updateImage()
 
             # for each subimg, we apply the correlation method for ring finding
             intThr = np.float(self.intThresEdit.text())
@@ -339,57 +366,154 @@ class Gollum(QtGui.QMainWindow):
             sinPow = np.float(self.sinPowerEdit.text())
             cArgs = minLen, thetaStep, deltaTh, wvlen, sinPow
 
-            # Single-core code
-            self.localCorr = np.zeros(len(blocksInput))
-            for i in np.arange(len(blocksInput)):
-                block = blocksInput[i]
-                blockS = blocksInputS[i]
-                mask = blocksMask[i]
-                # Block may be excluded from the analysis for two reasons.
-                # Firstly, because the intensity for all its pixels may be
-                # too low. Secondly, because the part of the block that
-                # belongs toa neuron may be below an arbitrary 30% of the
-                # block. We apply intensity threshold to smoothed data so we
-                # don't catch tiny bright spots outside neurons
-                neuronFrac = 1 - np.sum(mask)/np.size(mask)
-                thres = self.meanS + intThr*self.stdS
-                if np.any(blockS > thres) and neuronFrac > 0.25:
-                    output = tools.corrMethod(block, mask, *cArgs)
-                    angle, corrTheta, corrMax, theta, phase = output
-                    # Store results
-                    self.localCorr[i] = corrMax
-                else:
-                    self.localCorr[i] = np.nan
-
-            self.localCorr = self.localCorr.reshape(*self.n)
+            perfConfig = tools.loadPerformanceConfig()
+            bandThres = perfConfig.getfloat('Band power threshold')
+            nworkers = perfConfig.getint('Worker processes')
+            dirMethod = perfConfig.get('Direction method')
+            phaseMethod = perfConfig.get('Phase method')
+            thetaMethod = perfConfig.get('Angle method')
+
+            pool = self.workerPool(nworkers)
+
+            if not batch:
+                # The GUI is kept responsive and the results are shown as
+                # blocks are correlated
+                self.worker = AnalysisWorker(self.analysis, self.gaussSigma,
+                                             intThr, cArgs, bandThres,
+                                             dirMethod, nworkers, pool,
+                                             phaseMethod, thetaMethod)
+                self.workerThread = QtCore.QThread(self)
+                self.worker.moveToThread(self.workerThread)
+                self.workerThread.started.connect(self.worker.run)
+                self.worker.partialSignal.connect(self.showPartial)
+                self.worker.doneSignal.connect(self.analysisDone)
+                self.cancelButton.setEnabled(True)
+                self.fileStatus.setText('Analyzing...')
+                self.workerThread.start()
+                return
+
+            # Images of a batch that were already analyzed with the same
+            # settings are read from the cache
+            results = None
+            resultCache = cache.fromConfig(perfConfig) if batch else None
+            if resultCache is not None:
+                sigma = float(self.sigmaEdit.text())
+                key = resultCache.key(self.inputData, self.n, self.pxSize,
+                                      self.crop, sigma, intThr, cArgs,
+                                      bandThres, dirMethod,
+                                      phaseMethod=phaseMethod,
+                                      thetaMethod=thetaMethod)
+                results = resultCache.get(key)
+
+            if results is None:
+                # Only the stages and blocks affected by the parameters that
+                # changed since the last run are calculated
+                results = self.analysis.correlation(
+                    self.gaussSigma, intThr, cArgs, bandThres, dirMethod,
+                    nworkers, pool, phaseMethod=phaseMethod,
+                    thetaMethod=thetaMethod)[0]
+                if resultCache is not None:
+                    resultCache.put(key, *results)
+
+            results = [r.reshape(*self.n) for r in results]
+            self.localCorr, self.localTheta, self.localPhase = results
             self.updateGUI(self.localCorr)
 
         else:
             self.corrResult.clear()
             self.ringResult.clear()
 
-    def updateGUI(self, localCorr):
+    def workerPool(self, nworkers):
+        """Pool of nworkers processes for the correlation, see
+        tools.workerPool. It's started the first time it's needed and kept for
+        the following analysis, unless the number of workers or the settings
+        the workers start with change. None if the blocks are correlated in
+        this process."""
+
+        if nworkers == 0:
+            nworkers = mp.cpu_count()
+        if nworkers <= 1:
+            return None
+
+        poolArgs = (nworkers, templates.bank.filename, timer.enabled)
+        if self.pool is None or self.poolArgs != poolArgs:
+            self.closePool()
+            self.pool = tools.workerPool(nworkers)
+            self.poolArgs = poolArgs
+
+        return self.pool
+
+    def closePool(self):
+        if self.pool is not None:
+            # Blocks of a cancelled analysis may still be pending
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.poolArgs = None
+
+    def closeEvent(self, *args, **kwargs):
+        self.stopAnalysis()
+        self.closePool()
+        super().closeEvent(*args, **kwargs)
+
+    def showPartial(self, localCorr):
+        self.updateGUI(localCorr, partial=True)
+
+    def analysisDone(self, results, cancelled):
+
+        self.endWorker()
+        self.localCorr, self.localTheta, self.localPhase = results
+        self.updateGUI(self.localCorr, partial=cancelled)
+        if cancelled:
+            self.fileStatus.setText('Analysis cancelled')
+        else:
+            self.fileStatus.setText('Analysis done')
+
+    def cancelAnalysis(self):
+        # Blocks already correlated are shown and kept for the next run
+        if self.worker is not None:
+            self.worker.stopEvent.set()
+
+    def stopAnalysis(self):
+        """Stops the running analysis, if any, discarding its results."""
+
+        if self.worker is not None:
+            self.worker.partialSignal.disconnect(self.showPartial)
+            self.worker.doneSignal.disconnect(self.analysisDone)
+            self.worker.stopEvent.set()
+            self.endWorker()
+
+    def endWorker(self):
+        self.workerThread.quit()
+        self.workerThread.wait()
+        self.worker = None
+        self.workerThread = None
+        self.cancelButton.setEnabled(False)
+
+    def updateRings(self):
+        # Thresholding the block grid, so it's fast enough for the slider
+        rings = np.nan_to_num(self.localCorr) > self.corrThres
+        showIm = np.fliplr(np.transpose(rings.astype(float)))
+        self.ringResult.setImage(showIm, levels=(0, 1))
+
+    def updateGUI(self, localCorr, partial=False):
 
         self.analyzed = True
         self.localCorr = localCorr
 
-        # code for visualization of the output
-        mag = np.array(self.inputData.shape)/self.n
-        self.localCorrBig = np.repeat(self.localCorr, mag[0], 0)
-        self.localCorrBig = np.repeat(self.localCorrBig, mag[1], 1)
-        showIm = 100*np.fliplr(np.transpose(self.localCorrBig))
+        # code for visualization of the output, one pixel per block (see the
+        # transform set in loadImage)
+        showIm = 100*np.fliplr(np.transpose(self.localCorr))
         self.corrResult.setImage(np.nan_to_num(showIm))
         self.corrResult.setZValue(10)    # make sure this image is on top
         self.corrResult.setOpacity(0.5)
 
         self.corrThres = float(self.corrThresEdit.text())
-        self.ringsBig = np.nan_to_num(self.localCorrBig) > self.corrThres
-        self.ringsBig = self.ringsBig.astype(float)
-        self.ringResult.setImage(np.fliplr(np.transpose(self.ringsBig)))
+        self.updateRings()
         self.ringResult.setZValue(10)    # make sure this image is on top
         self.ringResult.setOpacity(0.5)
 
-        if self.showCorrMapCheck.isChecked():
+        if self.showCorrMapCheck.isChecked() and not partial:
             plt.figure(figsize=(10, 8))
             data = self.localCorr.reshape(*self.n)
             data = np.flipud(data)
@@ -409,96 +533,58 @@ class Gollum(QtGui.QMainWindow):
                                            [('Tiff file', '.tif')],
                                            self.initialdir)
             nfiles = len(filenames)
+            perfConfig = tools.loadPerformanceConfig()
+            exportImages = perfConfig.getboolean('Export images')
+            timing = perfConfig.getboolean('Timing')
+            timer.enable(timing)
+            timer.reset()
             function(filenames[0])
-            corrArray = np.zeros((nfiles, self.n[0], self.n[1]))
-
-            # Expand correlation array so it matches data shape
-            corrExp = np.empty((nfiles, self.initShape[0], self.initShape[1]),
-                               dtype=np.single)
-            corrExp[:] = np.nan
-            ringsExp = np.empty((nfiles, self.initShape[0], self.initShape[1]),
-                                dtype=np.single)
-            ringsExp[:] = np.nan
 
+            # Only the block results are kept, in a store written file by
+            # file. Full resolution images are exported from it.
             path = os.path.split(filenames[0])[0]
-            folder = os.path.split(path)[1]
+            resultStore = store.ResultStore(store.storeName(path), filenames,
+                                            self.n, self.pxSize, self.crop,
+                                            self.initShape)
+
             self.folderStatus.setText('Processing folder ' + path)
             print('Processing folder', path)
             t0 = time.time()
-            for i in np.arange(nfiles):
-                print(os.path.split(filenames[i])[1])
-                self.fileStatus.setText(os.path.split(filenames[i])[1])
-                function(filenames[i])
-                self.ringFinder(False, batch=True)
-                corrArray[i] = self.localCorr
-
-                bound = (np.array(self.initShape) - self.crop).astype(np.int)
-                corrExp[i, self.crop:bound[0],
-                        self.crop:bound[1]] = self.localCorrBig
-
-                # Save correlation values array
-                corrName = utils.insertSuffix(filenames[i], '_correlation')
-                tiff.imsave(corrName, corrExp[i], software='Gollum',
-                            imagej=True,
-                            resolution=(1000/self.pxSize, 1000/self.pxSize),
-                            metadata={'spacing': 1, 'unit': 'um'})
-
-            # Saving ring images
-            ringsExp[corrExp < self.corrThres] = 0
-            ringsExp[corrExp >= self.corrThres] = 1
-            for i in np.arange(nfiles):
-                # Save correlation values array
-                ringName = utils.insertSuffix(filenames[i], '_rings')
-                tiff.imsave(ringName, ringsExp[i], software='Gollum',
-                            imagej=True,
-                            resolution=(1000/self.pxSize, 1000/self.pxSize),
-                            metadata={'spacing': 1, 'unit': 'um'})
-
-            # plot histogram of the correlation values
-            hrange = (np.min(np.nan_to_num(corrArray)),
-                      np.max(np.nan_to_num(corrArray)))
-            y, x, _ = plt.hist(corrArray.flatten(), bins=60, range=hrange)
-            x = (x[1:] + x[:-1])/2
-
-            # Save data array as txt
-            corrArrayFlat = corrArray.flatten()
-            validCorr = corrArrayFlat[~np.isnan(corrArrayFlat)]
-            validArr = np.repeat(np.arange(nfiles), np.prod(self.n))
-            validArr = validArr[~np.isnan(corrArrayFlat)]
-            valuesTxt = os.path.join(path, folder + 'corr_values.txt')
-            np.savetxt(valuesTxt, np.stack((validCorr, validArr), 1),
-                       fmt='%f\t%i')
-
-            # Plotting
-            plt.figure(0)
-            ringData = validCorr[validCorr > self.corrThres]
-            n = corrArray.size - np.count_nonzero(np.isnan(corrArray))
-            nring = np.sum(validCorr > self.corrThres)
-            ringFrac = nring / n
-            ringStd = math.sqrt(ringFrac*(1 - ringFrac)/n)
-            plt.bar(x, y, align='center', width=(x[1] - x[0]))
-            plt.plot((self.corrThres, self.corrThres), (0, np.max(y)), 'r--',
-                     linewidth=2)
-            text = ('ringFrac={0:.3f} +- {1:.3f} \n'
-                    'correlation threshold={2:.2f} \n'
-                    'mean correlation={3:.4f} +- {4:.4f} \n'
-                    'mean ring correlation={5:.4f} +- {6:.4f}')
-            text = text.format(ringFrac, ringStd, self.corrThres,
-                               np.mean(validCorr), np.std(validCorr)/n,
-                               np.mean(ringData), np.std(ringData)/nring)
-            plt.text(0.8*plt.axis()[1], 0.8*plt.axis()[3], text,
-                     horizontalalignment='center', verticalalignment='center',
-                     bbox=dict(facecolor='white'))
-            plt.title("Correlations Histogram")
-            plt.xlabel("Value")
-            plt.ylabel("Frequency")
-            plt.savefig(os.path.join(path, folder + 'corr_hist'))
-            plt.close()
+            try:
+                for i in np.arange(nfiles):
+                    print(os.path.split(filenames[i])[1])
+                    self.fileStatus.setText(os.path.split(filenames[i])[1])
+                    timer.setFile(filenames[i])
+                    with timer.stage('load'):
+                        function(filenames[i])
+                    self.ringFinder(False, batch=True)
+                    with timer.stage('write'):
+                        resultStore.write(i, self.localCorr, self.localTheta,
+                                          self.localPhase)
+                        if exportImages:
+                            resultStore.exportImages([i], rings=False)
+
+                # Ring flags and images
+                timer.setFile(None)
+                with timer.stage('rings'):
+                    resultStore.setRings(self.corrThres)
+                    if exportImages:
+                        resultStore.exportImages(correlation=False)
+
+                # Correlation values table and histogram
+                pipeline.saveSummary(path, resultStore.corrArray(),
+                                     self.corrThres)
+
+            finally:
+                resultStore.close()
 
             folder = os.path.split(path)[1]
             text = 'Folder ' + folder + ' done in {0:.0f} seconds'
             print(text.format(time.time() - t0))
             self.folderStatus.setText(text.format(time.time() - t0))
+            if timing:
+                timer.summary(sys.stdout)
+                timer.dump(timingName(path))
             self.fileStatus.setText('                 ')
 
         except IndexError:
@@ -510,6 +596,43 @@ class Gollum(QtGui.QMainWindow):
     def batchSTED(self):
         self.batch(self.loadSTED, 'STED')
 
+
+class AnalysisWorker(QtCore.QObject):
+    """Correlation of the blocks of an image (see
+    stages.StagedAnalysis.correlation) to be run in a QThread. The
+    correlation of the blocks analyzed so far is emitted every interval
+    seconds, and the analysis stops within one block when stopEvent is set."""
+
+    partialSignal = QtCore.pyqtSignal(np.ndarray)
+    doneSignal = QtCore.pyqtSignal(object, bool)
+
+    def __init__(self, analysis, gaussSigma, intThr, cArgs, bandThres,
+                 dirMethod, nworkers, pool=None, phaseMethod='scan',
+                 thetaMethod='grid', interval=0.2):
+        super().__init__()
+
+        self.analysis = analysis
+        self.args = (gaussSigma, intThr, cArgs, bandThres, dirMethod,
+                     nworkers, pool)
+        self.methods = {'phaseMethod': phaseMethod,
+                        'thetaMethod': thetaMethod}
+        self.interval = interval
+        self.stopEvent = threading.Event()
+        self.lastEmit = 0
+
+    def partial(self, localCorr):
+        now = time.time()
+        if now - self.lastEmit >= self.interval:
+            self.lastEmit = now
+            self.partialSignal.emit(localCorr.copy())
+
+    def run(self):
+        results = self.analysis.correlation(*self.args, callback=self.partial,
+                                            stopEvent=self.stopEvent,
+                                            **self.methods)[0]
+        self.doneSignal.emit(results, self.stopEvent.is_set())
+
+
 if __name__ == '__main__':
     app = QtGui.QApplication([])
     win = Gollum()
@@ -13,8 +13,9 @@ import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 
 import labnanofisica.utils as utils
-from labnanofisica.ringfinder.neurosimulations import simAxon
+import labnanofisica.ringfinder.templates as templates
 import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.widgets as widgets
 
 
 class GollumDeveloper(QtGui.QMainWindow):
@@ -217,7 +218,7 @@ class ImageWidget(pg.GraphicsLayoutWidget):
 
         # Custom ROI for selecting an image region
         pxSize = np.float(self.main.STEDPxEdit.text())
-        self.roi = tools.SubImgROI(self.main.subImgSize/pxSize)
+        self.roi = widgets.SubImgROI(self.main.subImgSize/pxSize)
         self.inputVb.addItem(self.roi)
         self.roi.setZValue(10)  # make sure ROI is drawn above image
         self.roi.setOpacity(0.5)
@@ -301,7 +302,7 @@ class ImageWidget(pg.GraphicsLayoutWidget):
                 self.subimgPxSize = float(self.main.roiSizeEdit.text())
                 self.subimgPxSize /= self.pxSize
                 self.n = (np.array(self.shape)/self.subimgPxSize).astype(int)
-                self.grid = tools.Grid(self.inputVb, self.shape, self.n)
+                self.grid = widgets.Grid(self.inputVb, self.shape, self.n)
 
                 self.inputVb.setLimits(xMin=-0.05*self.shape[0],
                                        xMax=1.05*self.shape[0], minXRange=4,
@@ -410,9 +411,9 @@ class ImageWidget(pg.GraphicsLayoutWidget):
             self.th0, corrTheta, corrMax, thetaMax, phaseMax = output
 
             if np.all([self.th0, corrMax]) is not None:
-                self.bestAxon = simAxon(imSize=self.subImgSize, wvlen=wvlen,
-                                        theta=thetaMax, phase=phaseMax,
-                                        b=sinPow).data
+                self.bestAxon = templates.bank.template(self.subImgSize, wvlen,
+                                                        sinPow, thetaMax,
+                                                        phaseMax)
                 self.bestAxon = np.ma.array(self.bestAxon,
                                             mask=self.selectedMask,
                                             fill_value=0)
@@ -8,11 +8,8 @@ Created on Fri Jul 15 12:25:40 2016
 """
 
 import os
-import time
-import math
 import numpy as np
 from scipy import ndimage as ndi
-import tifffile as tiff
 from PIL import Image
 import matplotlib.pyplot as plt
 import pyqtgraph as pg
@@ -20,6 +17,10 @@ from pyqtgraph.Qt import QtGui, QtCore
 
 import labnanofisica.utils as utils
 import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.widgets as widgets
+import labnanofisica.ringfinder.pipeline as pipeline
+import labnanofisica.ringfinder.cache as cache
+import labnanofisica.ringfinder.templates as templates
 
 
 class Gollum(QtGui.QMainWindow):
@@ -206,9 +207,7 @@ class Gollum(QtGui.QMainWindow):
         self.corrSlider.setValue(1000*float(text))
         if self.analyzed:
             self.corrThres = float(text)
-            self.ringsBig = np.nan_to_num(self.localCorrBig) > self.corrThres
-            self.ringsBig = self.ringsBig.astype(float)
-            self.ringResult.setImage(np.fliplr(np.transpose(self.ringsBig)))
+            self.updateRings()
 
     def loadSTED(self, filename=None):
         prevSigma = self.sigmaEdit.text()
@@ -301,7 +300,13 @@ class Gollum(QtGui.QMainWindow):
         self.ringImgItem.setImage(np.fliplr(np.transpose(inputData)))
 
         shape = inputData.shape
-        self.grid = tools.Grid(self.corrVb, shape, n)
+        self.grid = widgets.Grid(self.corrVb, shape, n)
+
+        # Results are shown at block resolution, scaled to the image
+        mag = np.array(shape)/n
+        blockTransform = QtGui.QTransform.fromScale(mag[1], mag[0])
+        self.corrResult.setTransform(blockTransform)
+        self.ringResult.setTransform(blockTransform)
         self.corrVb.setLimits(xMin=-0.05*shape[0], xMax=1.05*shape[0],
                               yMin=-0.05*shape[1], yMax=1.05*shape[1],
                               minXRange=4, minYRange=4)
@@ -358,6 +363,12 @@ class Gollum(QtGui.QMainWindow):
             self.corrResult.clear()
             self.ringResult.clear()
 
+    def updateRings(self):
+        # Thresholding the block grid, so it's fast enough for the slider
+        rings = np.nan_to_num(self.localCorr) > self.corrThres
+        showIm = np.fliplr(np.transpose(rings.astype(float)))
+        self.ringResult.setImage(showIm, levels=(0, 1))
+
     def updateFileStatus(self):
         self.fileStatus.setText(os.path.split(self.filename)[1])
 
@@ -372,17 +383,13 @@ class Gollum(QtGui.QMainWindow):
         self.analyzed = True
         self.localCorr = localCorr
 
-        # code for visualization of the output
-        mag = np.array(self.inputData.shape)/self.n
-        self.localCorrBig = np.repeat(self.localCorr, mag[0], 0)
-        self.localCorrBig = np.repeat(self.localCorrBig, mag[1], 1)
-        showIm = 100*np.fliplr(np.transpose(self.localCorrBig))
+        # code for visualization of the output, one pixel per block (see the
+        # transform set in updateInput)
+        showIm = 100*np.fliplr(np.transpose(self.localCorr))
         self.corrResult.setImage(np.nan_to_num(showIm))
 
         self.corrThres = float(self.corrThresEdit.text())
-        self.ringsBig = np.nan_to_num(self.localCorrBig) > self.corrThres
-        self.ringsBig = self.ringsBig.astype(float)
-        self.ringResult.setImage(np.fliplr(np.transpose(self.ringsBig)))
+        self.updateRings()
 
         if self.showCorrMapCheck.isChecked():
             plt.figure(figsize=(10, 8))
@@ -451,6 +458,7 @@ class Gollum(QtGui.QMainWindow):
                                   cArgs)
             self.batchThread = QtCore.QThread(self)
             self.batchObj.startSignal.connect(self.updateBar)
+            self.batchObj.doneSignal.connect(self.batchDone)
             self.batchObj.moveToThread(self.batchThread)
             self.batchThread.started.connect(self.batchObj.start)
             self.batchThread.start()
@@ -568,6 +576,16 @@ class Gollum(QtGui.QMainWindow):
 #                    resolution=(1000/self.pxSize, 1000/self.pxSize),
 #                    metadata={'spacing': 1, 'unit': 'um'})
 
+    def batchDone(self, corrArray):
+        path = self.batchObj.path
+        ringFrac, ringStd = pipeline.saveSummary(path, corrArray,
+                                                 self.batchObj.corrThres)
+        text = 'Folder {0} done, ringFrac={1:.3f}'
+        self.folderStatus.setText(text.format(os.path.split(path)[1],
+                                              ringFrac))
+        self.fileStatus.setText('                 ')
+        self.batchThread.quit()
+
     def batchSTORM(self):
         self.batch('STORM')
 
@@ -603,6 +621,17 @@ class Worker(QtCore.QRunnable):
         self.signals.start.emit()
         localCorr = np.zeros(len(self.blocksInput))
 
+        # cArgs starts with the discrimination threshold, corrMethod doesn't
+        # use it
+        cArgs = self.cArgs[1:]
+        wvlen = cArgs[3]
+
+        # Band power of the rings' frequency for every block at once
+        perfConfig = tools.loadPerformanceConfig()
+        bandThres = perfConfig.getfloat('Band power threshold')
+        if bandThres > 0:
+            band = tools.bandPower(self.blocksInput, wvlen)
+
         # Single-core code
         for i in np.arange(len(self.blocksInput)):
             rings = False
@@ -618,10 +647,15 @@ class Worker(QtCore.QRunnable):
             neuronFrac = 1 - np.sum(mask)/np.size(mask)
             thres = self.meanS + self.intThr*self.stdS
             if np.any(blockS > thres) and neuronFrac > 0.25:
-                output = tools.corrMethod(block, mask, *self.cArgs)
-                angle, corrTheta, corrMax, theta, phase, rings = output
-                # Store results
-                localCorr[i] = corrMax
+                # Blocks with no periodicity near the rings' one can't have
+                # rings, there's no need to correlate them
+                if bandThres > 0 and band[i] < bandThres:
+                    localCorr[i] = 0
+                else:
+                    output = tools.corrMethod(block, mask, *cArgs)
+                    angle, corrTheta, corrMax, theta, phase = output
+                    # Store results
+                    localCorr[i] = corrMax
             else:
                 localCorr[i] = np.nan
 
@@ -661,92 +695,49 @@ class Single(QtCore.QObject):
 class Batch(QtCore.QObject):
 
     startSignal = QtCore.pyqtSignal(str)
+    doneSignal = QtCore.pyqtSignal(np.ndarray)
 
     def __init__(self, files, pxSize, crop, gaussSigma, intThres, cArgs):
         super().__init__()
 
         self.files = files
-        self.pxSize = pxSize
-        self.crop = crop
-        self.gaussSigma = gaussSigma/self.pxSize
-        self.intThres = intThres
-        self.cArgs = cArgs
-
-        self.pool = QtCore.QThreadPool()
-        self.pool.setMaxThreadCount(1)
-
-        self.nfiles = len(files)
-        self.subimgPxSize = 1000/self.pxSize
-
-        # Get data shape and derivates
-        im = Image.open(self.files[0])
-        inputData = np.array(im).astype(np.float64)
-        initShape = inputData.shape
-        self.bound = (np.array(inputData.shape) - self.crop).astype(np.int)
-        inputData = inputData[self.crop:self.bound[0], self.crop:self.bound[1]]
-        dataShape = inputData.shape
-        self.n = (np.array(dataShape)/self.subimgPxSize).astype(int)
-        self.mag = np.array(dataShape)/self.n
-        self.corrArray = np.zeros((self.nfiles, self.n[0], self.n[1]))
-        self.path = os.path.split(self.files[0])[0]
-        self.corrExp = np.empty((self.nfiles, initShape[0], initShape[1]),
-                                dtype=np.single)
-        self.corrExp[:] = np.nan
-        self.ringsExp = np.empty((self.nfiles, initShape[0], initShape[1]),
-                                 dtype=np.single)
-        self.ringsExp[:] = np.nan
-
-    def processResult(self, localCorr):
-        self.corrArray[self.i] = localCorr
-
-        localCorrBig = np.repeat(localCorr, self.mag[0], 0)
-        localCorrBig = np.repeat(localCorrBig, self.mag[1], 1)
-
-        self.corrExp[self.i, self.crop:self.bound[0],
-                     self.crop:self.bound[1]] = localCorrBig
-
-        # Save correlation values array
-        corrName = utils.insertSuffix(self.files[self.i], '_correlation')
-        tiff.imsave(corrName, self.corrExp[self.i], software='Gollum',
-                    imagej=True, metadata={'spacing': 1, 'unit': 'um'},
-                    resolution=(1000/self.pxSize, 1000/self.pxSize))
-
-    def updateBar(self):
-        self.startSignal.emit(os.path.split(self.files[self.i])[1])
+        self.corrThres = cArgs[0]
+
+        # cArgs starts with the discrimination threshold, corrMethod doesn't
+        # use it
+        perfConfig = tools.loadPerformanceConfig()
+        templates.fromConfig(perfConfig)
+        self.pipeline = pipeline.Pipeline(
+            files, pxSize, crop, gaussSigma, intThres, cArgs[1:],
+            nworkers=perfConfig.getint('Worker processes'),
+            bandThres=perfConfig.getfloat('Band power threshold'),
+            cache=cache.fromConfig(perfConfig),
+            dirMethod=perfConfig.get('Direction method'),
+            dtype=tools.computeDtype(perfConfig),
+            exportImages=perfConfig.getboolean('Export images'),
+            levels=perfConfig.getint('Adaptive levels'),
+            corrThres=self.corrThres,
+            margin=perfConfig.getfloat('Adaptive margin'),
+            decision=perfConfig.getboolean('Decision mode'),
+            phaseMethod=perfConfig.get('Phase method'),
+            thetaMethod=perfConfig.get('Angle method'))
+        self.n = self.pipeline.n
+        self.path = self.pipeline.path
+
+    def updateBar(self, i):
+        self.startSignal.emit(os.path.split(self.files[i])[1])
 
     def start(self):
-
-        t0 = time.time()
-        for i in np.arange(self.nfiles):
-
-            self.i = i
-
-            # Image loading
-            im = Image.open(self.files[i])
-            inputData = np.array(im).astype(np.float64)
-            inputData = inputData[self.crop:self.bound[0],
-                                  self.crop:self.bound[1]]
-
-            inputDataS = ndi.gaussian_filter(inputData, self.gaussSigma)
-            meanS = np.mean(inputDataS)
-            stdS = np.std(inputDataS)
-
-            # binarization of image
-            mask = inputDataS < meanS + self.intThres*stdS
-            # shape the data into the subimg that we need for the analysis
-            nblocks = np.array(inputData.shape)/self.n
-            blocksInput = tools.blockshaped(inputData, *nblocks)
-            blocksInputS = tools.blockshaped(inputDataS, *nblocks)
-            blocksMask = tools.blockshaped(mask, *nblocks)
-
-            worker = Worker(self.n, blocksInput, blocksInputS, blocksMask,
-                            self.intThres, self.cArgs)
-            worker.signals.start.connect(self.updateBar)
-            worker.signals.done.connect(self.processResult)
-
-            self.pool.start(worker)
-
-        self.pool.waitForDone()
+        # Images are loaded, correlated and saved in overlapping stages
+        try:
+            self.corrArray = self.pipeline.run(started=self.updateBar)
+            self.pipeline.saveRings(self.corrThres)
+        finally:
+            self.pipeline.close()
+        self.doneSignal.emit(self.corrArray)
+
+    def stop(self):
+        self.pipeline.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Ring finder analysis of images too large to be loaded at once, like stitched
+slide scans. The image is read tile by tile from a memory mapped tiff file,
+so the memory use is a few tiles whatever the image size.
+"""
+
+import math
+import multiprocessing as mp
+import numpy as np
+from scipy import ndimage as ndi
+import tifffile as tiff
+
+import labnanofisica.utils as utils
+import labnanofisica.ringfinder.tools as tools
+
+
+def openImage(filename):
+    """2D image of a tiff file as a read only array whose data is read from
+    disk on demand. Uncompressed files are memory mapped, compressed ones are
+    read through zarr, an optional dependency (the 'slide' extra of
+    setup.py)."""
+
+    try:
+        return tiff.memmap(filename, mode='r')
+    except ValueError:
+        pass
+
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(filename + ' is compressed, and compressed images '
+                          'can only be read tile by tile with zarr. Install '
+                          'it with: pip install zarr')
+    return zarr.open(tiff.imread(filename, aszarr=True), mode='r')
+
+
+def readTile(image, y0, y1, x0, x1, halo, region, dtype=np.float64):
+    """Area [y0:y1, x0:x1] of the image with a border of halo pixels. The
+    border beyond region (y0, y1, x0, x1) is its mirror image, like the
+    'reflect' mode of the scipy.ndimage filters, so filtering the tile and
+    cropping its border gives the same result as filtering the whole region.
+    """
+
+    top, left = max(y0 - halo, region[0]), max(x0 - halo, region[2])
+    bottom, right = min(y1 + halo, region[1]), min(x1 + halo, region[3])
+    tile = np.asarray(image[top:bottom, left:right], dtype=dtype)
+
+    pad = ((top - (y0 - halo), (y1 + halo) - bottom),
+           (left - (x0 - halo), (x1 + halo) - right))
+    if np.any(pad):
+        tile = np.pad(tile, pad, mode='symmetric')
+
+    return tile
+
+
+def tiles(y0, y1, x0, x1, size):
+    """Limits of the tiles of side size covering [y0:y1, x0:x1]."""
+
+    for ty in np.arange(y0, y1, size):
+        for tx in np.arange(x0, x1, size):
+            yield ty, min(ty + size, y1), tx, min(tx + size, x1)
+
+
+def smoothedStats(image, region, gaussSigma, tileSize, dtype=np.float64):
+    """Mean and std of the smoothed image within region (y0, y1, x0, x1),
+    calculated tile by tile. Tile statistics are combined with the parallel
+    algorithm of Chan et al., which doesn't lose precision with large means.
+    """
+
+    # Same kernel radius as ndi.gaussian_filter
+    radius = int(4*gaussSigma + 0.5)
+
+    count, mean, m2 = 0, 0., 0.
+    for y0, y1, x0, x1 in tiles(*region, tileSize):
+        tile = readTile(image, y0, y1, x0, x1, radius, region, dtype)
+        tileS = ndi.gaussian_filter(tile, gaussSigma)
+        tileS = tileS[radius:radius + y1 - y0, radius:radius + x1 - x0]
+
+        n = tileS.size
+        tileMean = np.mean(tileS, dtype=np.float64)
+        tileM2 = np.sum((tileS - tileMean)**2, dtype=np.float64)
+        delta = tileMean - mean
+        total = count + n
+        mean += delta*n/total
+        m2 += tileM2 + delta**2*count*n/total
+        count = total
+
+    return mean, math.sqrt(m2/count)
+
+
+def analyzeSlide(filename, pxSize, crop, gaussSigma, intThres, cArgs,
+                 tileBlocks=16, nworkers=0, bandThres=0, dirMethod='tensor',
+                 dtype=np.float64, progress=None, phaseMethod='scan',
+                 thetaMethod='grid'):
+    """Ring finder analysis of a large image, tile by tile. In a first pass
+    the intensity statistics of the smoothed image are calculated, and in a
+    second one the blocks of each tile are smoothed, binarized and correlated.
+    Tiles are read with a border of ceil(4 sigma) pixels, so the result is the
+    same as the analysis of the whole image.
+
+    filename: tiff file of a 2D image
+    pxSize: pixel size in nm
+    crop: number of pixels cropped from each border of the image
+    gaussSigma: sigma of the gaussian filter in nm
+    intThres: intensity threshold in units of the smoothed image's std
+    cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod
+    tileBlocks: side of the tiles in blocks
+    nworkers: number of worker processes, see tools.corrBlocks
+    bandThres: band power threshold, see tools.corrBlock
+    dirMethod: neurite direction method, see pipeline.Pipeline
+    dtype: float type of the analysis, see tools.computeDtype
+    progress: function called with the number of analyzed tiles and the
+    total, before the second pass and after each tile
+    phaseMethod, thetaMethod: phase and angle methods of tools.corrMethod
+
+    returns the correlation, angle and phase of every block, arrays with the
+    shape of the block grid"""
+
+    image = openImage(filename)
+    if len(image.shape) != 2:
+        raise ValueError(filename + ' is not a 2D image')
+
+    crop = int(crop)
+    region = (crop, image.shape[0] - crop, crop, image.shape[1] - crop)
+
+    # We need 1um n-sized subimages. Pixels beyond the last full block are
+    # only used for the intensity statistics.
+    blockSize = int(round(1000/pxSize))
+    n = ((region[1] - region[0])//blockSize,
+         (region[3] - region[2])//blockSize)
+    tileSize = tileBlocks*blockSize
+    sigmaPx = gaussSigma/pxSize
+
+    # First pass
+    meanS, stdS = smoothedStats(image, region, sigmaPx, tileSize, dtype)
+    thres = meanS + intThres*stdS
+
+    # Second pass. One more pixel of halo for the gradient of the directions.
+    halo = int(4*sigmaPx + 0.5) + 1
+    corr = np.zeros(n)
+    theta = np.zeros(n)
+    phase = np.zeros(n)
+    gridEnd = (region[0] + n[0]*blockSize, region[2] + n[1]*blockSize)
+    tileList = list(tiles(region[0], gridEnd[0], region[2], gridEnd[1],
+                          tileSize))
+
+    if nworkers == 0:
+        nworkers = mp.cpu_count()
+    pool = tools.workerPool(nworkers) if nworkers > 1 else None
+
+    if progress is not None:
+        progress(0, len(tileList))
+
+    try:
+        for t in np.arange(len(tileList)):
+            y0, y1, x0, x1 = tileList[t]
+            tile = readTile(image, y0, y1, x0, x1, halo, region, dtype)
+            tileS = ndi.gaussian_filter(tile, sigmaPx)
+            interior = (slice(halo, halo + y1 - y0),
+                        slice(halo, halo + x1 - x0))
+
+            data = tile[interior]
+            dataS = tileS[interior]
+            mask = dataS < thres
+
+            blocksInput = tools.blockshaped(data, blockSize, blockSize)
+            blocksInputS = tools.blockshaped(dataS, blockSize, blockSize)
+            blocksMask = tools.blockshaped(mask, blockSize, blockSize)
+            if dirMethod == 'tensor':
+                dataS1 = tileS[halo - 1:halo + y1 - y0 + 1,
+                               halo - 1:halo + x1 - x0 + 1]
+                directions = tools.blockDirections(dataS1, blockSize,
+                                                   blockSize, halo=1)[0]
+            else:
+                directions = tools.houghDirections(blocksMask, cArgs[0])
+
+            results = tools.corrBlocks(blocksInput, blocksInputS, blocksMask,
+                                       thres, cArgs, bandThres, nworkers,
+                                       pool, directions,
+                                       phaseMethod=phaseMethod,
+                                       thetaMethod=thetaMethod)
+
+            # Position of the tile's blocks in the grid
+            shape = ((y1 - y0)//blockSize, (x1 - x0)//blockSize)
+            i0 = (y0 - region[0])//blockSize
+            j0 = (x0 - region[2])//blockSize
+            grid = (slice(i0, i0 + shape[0]), slice(j0, j0 + shape[1]))
+            corr[grid], theta[grid], phase[grid] = [r.reshape(shape)
+                                                    for r in results]
+
+            if progress is not None:
+                progress(t + 1, len(tileList))
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return corr, theta, phase
+
+
+def saveGrid(filename, corr, theta, phase, pxSize, crop):
+    """Saves the results of analyzeSlide at block resolution: a
+    _correlation_grid tiff (one pixel per block) and the correlation, angle
+    and phase of every block in a _grid.npz file."""
+
+    blockSize = int(round(1000/pxSize))
+    blockUm = blockSize*pxSize/1000
+    tiff.imwrite(utils.insertSuffix(filename, '_correlation_grid'),
+                 corr.astype(np.single), software='Gollum', imagej=True,
+                 resolution=(1/blockUm, 1/blockUm),
+                 metadata={'spacing': 1, 'unit': 'um'})
+    np.savez(utils.insertSuffix(filename, '_grid', '.npz'), corr=corr,
+             theta=theta, phase=phase, pxSize=pxSize, crop=crop,
+             blockSize=blockSize)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from scipy import ndimage as ndi
+
+import labnanofisica.ringfinder.tools as tools
+from labnanofisica.ringfinder.timing import timer
+
+
+class StagedAnalysis:
+    """Ring finder analysis of one image split in cached stages:
+
+        load -> smooth -> mask -> blocks -> direction -> correlation
+
+    Each stage keeps its last result together with the parameters and the
+    versions of the stages it was calculated from, and it's only calculated
+    again when one of them changes. The correlation is also kept per block:
+    only blocks whose mask, direction or discrimination changed are
+    correlated again, unless a correlation parameter changed."""
+
+    def __init__(self):
+        self.setImage(None, None)
+
+    def setImage(self, inputData, n):
+        """New input image, already cropped, to be split in n blocks."""
+
+        self.inputData = inputData
+        self.n = n
+        if inputData is not None:
+            self.nblocks = np.array(inputData.shape)/n
+
+        # Every stage is calculated again for the new image
+        self.results = {}
+        self.keys = {}
+        self.versions = {'load': 0}
+
+        # Last correlation of every block and what it was calculated from
+        self.corrKey = None
+        self.corrBlocks = None
+
+    def stage(self, name, params, inputs, compute):
+        """Result of a stage, calculated with compute() only if params or the
+        version of any of the input stages changed since the last call."""
+
+        key = (params, tuple(self.versions[i] for i in inputs))
+        if self.keys.get(name) != key:
+            with timer.stage(name):
+                self.results[name] = compute()
+            self.keys[name] = key
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+        return self.results[name]
+
+    def smooth(self, gaussSigma):
+        """Smoothed image, its mean and std. gaussSigma in px."""
+
+        def compute():
+            inputDataS = ndi.gaussian_filter(self.inputData, gaussSigma)
+            return (inputDataS, np.mean(inputDataS, dtype=np.float64),
+                    np.std(inputDataS, dtype=np.float64))
+
+        return self.stage('smooth', (gaussSigma, ), ('load', ), compute)
+
+    def mask(self, gaussSigma, intThr):
+        """Binarization of the image, True means background."""
+
+        inputDataS, meanS, stdS = self.smooth(gaussSigma)
+        return self.stage('mask', (intThr, ), ('smooth', ),
+                          lambda: inputDataS < meanS + intThr*stdS)
+
+    def blocks(self, gaussSigma, intThr):
+        """Blocks of the image, the smoothed image and the mask, and the
+        intensity threshold for the smoothed blocks."""
+
+        inputDataS, meanS, stdS = self.smooth(gaussSigma)
+        mask = self.mask(gaussSigma, intThr)
+
+        def compute():
+            blocksInput = tools.blockshaped(self.inputData, *self.nblocks)
+            blocksInputS = tools.blockshaped(inputDataS, *self.nblocks)
+            blocksMask = tools.blockshaped(mask, *self.nblocks)
+            thres = meanS + intThr*stdS
+            return blocksInput, blocksInputS, blocksMask, thres
+
+        return self.stage('blocks', (), ('smooth', 'mask'), compute)
+
+    def direction(self, gaussSigma, intThr, dirMethod, minLen):
+        """Neurite direction of every block, see tools.blockDirections and
+        tools.houghDirections."""
+
+        if dirMethod == 'tensor':
+            inputDataS = self.smooth(gaussSigma)[0]
+            return self.stage('direction', (dirMethod, ), ('smooth', ),
+                              lambda: tools.blockDirections(inputDataS,
+                                                            *self.nblocks)[0])
+        else:
+            blocksMask = self.blocks(gaussSigma, intThr)[2]
+            return self.stage('direction', (dirMethod, minLen), ('blocks', ),
+                              lambda: tools.houghDirections(blocksMask,
+                                                            minLen))
+
+    def correlation(self, gaussSigma, intThr, cArgs, bandThres=0,
+                    dirMethod='tensor', nworkers=1, pool=None, callback=None,
+                    stopEvent=None, phaseMethod='scan', thetaMethod='grid'):
+        """Correlation, angle and phase of every block, see tools.corrBlocks.
+        If the analysis is stopped with stopEvent, the blocks that weren't
+        correlated are nan and they're correlated in the next call.
+
+        pool: tools.workerPool with nworkers processes, so it's started once
+            for every analysis of the image
+        phaseMethod, thetaMethod: phase and angle methods of
+            tools.corrMethod
+
+        callback: function called with the correlation of every block, shape
+            n, each time some of them are correlated. Blocks not correlated
+            yet are nan.
+
+        returns the results with shape n and the number of blocks that were
+        correlated again"""
+
+        blocksInput, blocksInputS, blocksMask, thres = self.blocks(gaussSigma,
+                                                                   intThr)
+        directions = self.direction(gaussSigma, intThr, dirMethod, cArgs[0])
+
+        # Block discrimination, see tools.corrBlock
+        neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+        gate = np.logical_and(np.any(blocksInputS > thres, (1, 2)),
+                              neuronFrac > 0.25)
+
+        # With the structure tensor, minLen doesn't change the correlation
+        corrArgs = cArgs[1:] if dirMethod == 'tensor' else cArgs
+        corrKey = (tuple(corrArgs), bandThres, phaseMethod, thetaMethod)
+        if self.corrKey != corrKey or self.corrBlocks is None:
+            changed = np.ones(len(blocksInput), dtype=bool)
+            results = np.zeros((len(blocksInput), 3))
+        else:
+            prevMask, prevDirections, prevGate, results, done = self.corrBlocks
+            results = results.copy()
+            sameDir = np.logical_or(prevDirections == directions,
+                                    np.logical_and(np.isnan(prevDirections),
+                                                   np.isnan(directions)))
+            changed = np.logical_or(np.any(prevMask != blocksMask, (1, 2)),
+                                    np.logical_or(~sameDir, prevGate != gate))
+            changed = np.logical_or(changed, ~done)
+
+        ix = np.where(changed)[0]
+        done = ~changed
+        if len(ix) > 0:
+            results[ix] = np.nan
+            blockCallback = None
+            if callback is not None or stopEvent is not None:
+
+                def blockCallback(indices, blockResults):
+                    results[ix[indices]] = blockResults
+                    done[ix[indices]] = True
+                    if callback is not None:
+                        callback(results[:, 0].reshape(*self.n))
+
+            with timer.stage('corrBlocks'):
+                output = tools.corrBlocks(blocksInput[ix], blocksInputS[ix],
+                                          blocksMask[ix], thres, cArgs,
+                                          bandThres, nworkers, pool,
+                                          directions=directions[ix],
+                                          callback=blockCallback,
+                                          stopEvent=stopEvent,
+                                          phaseMethod=phaseMethod,
+                                          thetaMethod=thetaMethod)
+            if blockCallback is None:
+                results[ix] = np.stack(output, 1)
+                done[:] = True
+
+        self.corrKey = corrKey
+        self.corrBlocks = blocksMask, directions, gate, results, done
+
+        output = [r.reshape(*self.n) for r in results.T]
+        return output, len(ix)
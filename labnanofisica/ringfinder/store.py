@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+import h5py as hdf
+import tifffile as tiff
+
+import labnanofisica.utils as utils
+
+
+def storeName(path):
+    """Default result store of the batch analysis of a folder."""
+    folder = os.path.split(path)[1]
+    return os.path.join(path, folder + 'results.hdf5')
+
+
+def expandGrid(grid, shape, crop):
+    """Block grid expanded to an image of the given shape. The crop pixels of
+    each border are nan."""
+
+    bound = (np.array(shape) - crop).astype(int)
+    mag = ((bound - crop)/np.array(grid.shape)).astype(int)
+    gridBig = np.repeat(np.repeat(grid, mag[0], 0), mag[1], 1)
+
+    image = np.empty(shape, dtype=np.single)
+    image[:] = np.nan
+    image[crop:bound[0], crop:bound[1]] = gridBig
+
+    return image
+
+
+class ResultStore:
+    """Results of a batch analysis at block resolution, in a hdf5 file with
+    one chunk per image:
+
+    - corr, theta, phase: correlation, angle and phase of every block
+    - gate: True for the blocks that passed the discrimination (not nan)
+    - rings: bit-packed ring flags (corr >= the corrThres attribute)
+
+    Each image is written as soon as it's analyzed, so only its results are in
+    memory. The full resolution _correlation and _rings tiff images of the GUI
+    are exported on demand with exportImages.
+
+    To create a store, pass the analysis geometry; without it an existing
+    store is opened.
+
+    filename: hdf5 file
+    files: filenames of the analyzed images
+    n: number of blocks along each axis
+    pxSize: pixel size in nm
+    crop: number of pixels cropped from each border of the images
+    initShape: shape of the images before cropping"""
+
+    def __init__(self, filename, files=None, n=None, pxSize=None, crop=0,
+                 initShape=None):
+
+        self.filename = filename
+        if files is None:
+            self.file = hdf.File(filename, 'r+')
+            attrs = self.file.attrs
+            self.files = [f.decode() if isinstance(f, bytes) else f
+                          for f in attrs['files']]
+            self.n = tuple(attrs['n'])
+            self.pxSize = attrs['pxSize']
+            self.crop = int(attrs['crop'])
+            self.initShape = tuple(attrs['initShape'])
+            return
+
+        self.files = list(files)
+        self.n = tuple(int(v) for v in n)
+        self.pxSize = pxSize
+        self.crop = int(crop)
+        self.initShape = tuple(int(v) for v in initShape)
+
+        self.file = hdf.File(filename, 'w')
+        attrs = self.file.attrs
+        attrs['files'] = np.array(self.files, dtype=hdf.string_dtype())
+        attrs['n'] = self.n
+        attrs['pxSize'] = pxSize
+        attrs['crop'] = self.crop
+        attrs['initShape'] = self.initShape
+
+        nfiles = len(self.files)
+        shape = (nfiles, ) + self.n
+        chunks = (1, ) + self.n
+        for name in ['corr', 'theta', 'phase']:
+            self.file.create_dataset(name, shape, dtype=np.float32,
+                                     chunks=chunks, compression='gzip',
+                                     fillvalue=np.nan)
+        self.file.create_dataset('gate', shape, dtype=bool, chunks=chunks)
+        nbytes = int(np.ceil(self.n[0]*self.n[1]/8))
+        dset = self.file.create_dataset('rings', (nfiles, nbytes),
+                                        dtype=np.uint8, chunks=(1, nbytes))
+        dset.attrs['corrThres'] = np.nan
+
+    def write(self, i, localCorr, localTheta, localPhase):
+        """Saves the results of the i-th image."""
+
+        self.file['corr'][i] = localCorr
+        self.file['theta'][i] = localTheta
+        self.file['phase'][i] = localPhase
+        self.file['gate'][i] = ~np.isnan(localCorr)
+        self.file.flush()
+
+    def read(self, i):
+        """Correlation, angle and phase of the blocks of the i-th image."""
+        return [self.file[name][i] for name in ['corr', 'theta', 'phase']]
+
+    def corrArray(self):
+        """Correlation of every block of every image."""
+        return self.file['corr'][:].astype(np.float64)
+
+    def setRings(self, corrThres):
+        """Flags the blocks with correlation over corrThres, image by image."""
+
+        rings = self.file['rings']
+        for i in np.arange(len(self.files)):
+            corr = self.file['corr'][i]
+            rings[i] = np.packbits(np.nan_to_num(corr) >= corrThres)
+        rings.attrs['corrThres'] = corrThres
+        self.file.flush()
+
+    def rings(self, i):
+        """Ring flags of the blocks of the i-th image, see setRings."""
+
+        size = self.n[0]*self.n[1]
+        flags = np.unpackbits(self.file['rings'][i])[:size].astype(bool)
+        return flags.reshape(self.n)
+
+    def saveImage(self, i, suffix, data):
+        name = utils.insertSuffix(self.files[i], suffix)
+        tiff.imwrite(name, data, software='Gollum', imagej=True,
+                     resolution=(1000/self.pxSize, 1000/self.pxSize),
+                     metadata={'spacing': 1, 'unit': 'um'})
+
+    def exportImages(self, indices=None, correlation=True, rings=True):
+        """Saves the full resolution images of the given images (all by
+        default), one at a time: _correlation with the correlation of every
+        block and _rings with 1 for the blocks with rings, 0 for the ones
+        without them and nan outside neurons. The rings are the ones of the
+        last setRings call."""
+
+        if indices is None:
+            indices = np.arange(len(self.files))
+
+        for i in indices:
+            corr = self.file['corr'][i]
+            if correlation:
+                self.saveImage(i, '_correlation',
+                               expandGrid(corr, self.initShape, self.crop))
+            if rings:
+                ringsGrid = self.rings(i).astype(np.single)
+                ringsGrid[np.isnan(corr)] = np.nan
+                self.saveImage(i, '_rings', expandGrid(ringsGrid,
+                                                       self.initShape,
+                                                       self.crop))
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+from collections import OrderedDict
+import multiprocessing as mp
+import numpy as np
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.pipeline as pipeline
+
+# Names of the corrMethod arguments in cArgs order
+cArgNames = ('minLen', 'thStep', 'deltaTh', 'wvlen', 'sinPow')
+
+
+def upstreamKey(setting, dirMethod):
+    """Parameters the smoothing, mask, blocks and directions depend on."""
+
+    key = (setting['gaussSigma'], setting['intThr'])
+    if dirMethod == 'hough':
+        key += (setting['minLen'], )
+    return key
+
+
+def sweep(data, pxSize, base, grid, nworkers=1, dirMethod='tensor'):
+    """Ring finder analysis of an image for every combination of the values of
+    the swept parameters. The smoothing, binarization, splitting in blocks and
+    neurite directions are calculated once for every distinct gaussSigma and
+    intThr (and minLen with the hough direction method), and shared by all
+    settings that only differ in the correlation parameters.
+
+    The discrimination threshold isn't a parameter, the returned correlations
+    can be compared with any threshold.
+
+    data: input image, already cropped
+    pxSize: pixel size in nm
+    base: dict with the value of every parameter that isn't swept:
+        gaussSigma (nm), intThr, minLen (px), thStep, deltaTh, wvlen (px),
+        sinPow and optionally bandThres
+    grid: dict parameter -> sequence of values to sweep
+    nworkers: number of worker processes, see tools.corrBlocks
+    dirMethod: neurite direction method, see pipeline.Pipeline
+
+    returns:
+
+    settings: list with the dict of parameters of each analysis
+    corr, theta, phase: arrays of shape (len(settings), nblocks) with the
+    results of each block (see tools.corrBlock)"""
+
+    names = list(grid)
+    settings = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        setting = dict(base)
+        setting.update(zip(names, values))
+        settings.append(setting)
+
+    # We need 1um n-sized subimages
+    n = (np.array(data.shape)/(1000/pxSize)).astype(int)
+    nblocks = np.array(data.shape)/n
+
+    corr = np.zeros((len(settings), n[0]*n[1]))
+    theta = np.zeros((len(settings), n[0]*n[1]))
+    phase = np.zeros((len(settings), n[0]*n[1]))
+
+    # Settings sharing the upstream stages
+    groups = OrderedDict()
+    for i in np.arange(len(settings)):
+        key = upstreamKey(settings[i], dirMethod)
+        groups.setdefault(key, []).append(i)
+
+    if nworkers == 0:
+        nworkers = mp.cpu_count()
+    pool = tools.workerPool(nworkers) if nworkers > 1 else None
+
+    try:
+        for key, indices in groups.items():
+            setting = settings[indices[0]]
+            output = pipeline.prepareImage(data, setting['gaussSigma']/pxSize,
+                                           setting['intThr'], nblocks,
+                                           dirMethod)
+            blocksInput, blocksInputS, blocksMask, thres, directions = output
+            if dirMethod == 'hough':
+                directions = tools.houghDirections(blocksMask,
+                                                   setting['minLen'])
+
+            for i in indices:
+                setting = settings[i]
+                cArgs = tuple(setting[name] for name in cArgNames)
+                bandThres = setting.get('bandThres', 0)
+                results = tools.corrBlocks(blocksInput, blocksInputS,
+                                           blocksMask, thres, cArgs,
+                                           bandThres, nworkers, pool,
+                                           directions)
+                corr[i], theta[i], phase[i] = results
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return settings, corr, theta, phase
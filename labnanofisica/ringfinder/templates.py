@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import os
+from collections import OrderedDict
+import numpy as np
+
+import labnanofisica.utils as utils
+from labnanofisica.ringfinder.neurosimulations import simAxonStack
+
+
+class TemplateBank:
+    """Simulated axons (neurosimulations.simAxon data) indexed by the full set
+    of parameters that define them, so each one is calculated only once.
+
+    The most recently used templates are kept in memory, up to maxSize of
+    them or the number reserved (see reserve) if it's larger. The bank can
+    be saved to a .npy file that is later opened memory mapped, so several
+    windows or worker processes analyzing with the same settings read the
+    same templates instead of rebuilding them (see fromConfig).
+
+    maxSize: maximum number of templates kept in memory
+    filename: .npy file of a previously saved bank. If it exists it's loaded
+        and it's the default destination of save()."""
+
+    def __init__(self, maxSize=2048, filename=None):
+
+        self.maxSize = maxSize
+        self.filename = filename
+        self.reserved = {}
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # Templates of the memory mapped file: key -> offset
+        self.stored = {}
+        self.storedData = None
+
+        if filename is not None and os.path.exists(filename):
+            self.load(filename)
+
+    @staticmethod
+    def key(subImgSize, wvlen, sinPow, theta, phase):
+        # Rounding so values that only differ in float representation share
+        # the same template
+        return (int(subImgSize), round(float(wvlen), 9), float(sinPow),
+                round(float(theta), 9), round(float(phase), 9))
+
+    @staticmethod
+    def family(subImgSize, wvlen, sinPow):
+        """Parameters shared by the templates of a given analysis, the first
+        ones of their keys."""
+        return TemplateBank.key(subImgSize, wvlen, sinPow, 0, 0)[:3]
+
+    def reserve(self, size, family=()):
+        """Makes room for size templates of the given family (see family),
+        besides the ones reserved for the other families. Reserving again
+        for the same family only enlarges its room."""
+
+        self.reserved[family] = max(self.reserved.get(family, 0), int(size))
+        self.maxSize = max(self.maxSize, sum(self.reserved.values()))
+
+    def lookup(self, key):
+        """Template of the key if it's in the bank, else None."""
+
+        try:
+            template = self.cache[key]
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return template
+        except KeyError:
+            pass
+
+        if key in self.stored:
+            # Memory mapped templates don't count for the memory limit
+            self.hits += 1
+            return self.storedTemplate(key)
+
+        self.misses += 1
+        return None
+
+    def add(self, key, template):
+        template.flags.writeable = False
+        self.cache[key] = template
+        if len(self.cache) > self.maxSize:
+            self.cache.popitem(last=False)
+
+    def template(self, subImgSize, wvlen, sinPow, theta, phase):
+        """Simulated axon of the given parameters. The returned array is read
+        only because it's shared with all other users of the bank."""
+
+        key = self.key(subImgSize, wvlen, sinPow, theta, phase)
+        template = self.lookup(key)
+        if template is None:
+            template = simAxonStack(subImgSize, wvlen, theta, phase,
+                                    b=sinPow)[0]
+            self.add(key, template)
+
+        return template
+
+    def stack(self, subImgSize, wvlen, sinPow, theta, phase,
+              dtype=np.float64):
+        """Stack of simulated axons of shape (len(theta), len(phase),
+        subImgSize, subImgSize) for every combination of the given angles and
+        phases. The templates are kept in double precision and converted to
+        dtype here. The ones missing in the bank are all calculated at once
+        with simAxonStack."""
+
+        templates = np.zeros((len(theta), len(phase), subImgSize, subImgSize),
+                             dtype=dtype)
+        missing = []
+        for t in np.arange(len(theta)):
+            for p in np.arange(len(phase)):
+                key = self.key(subImgSize, wvlen, sinPow, theta[t], phase[p])
+                template = self.lookup(key)
+                if template is None:
+                    missing.append((t, p, key))
+                else:
+                    templates[t, p] = template
+
+        if len(missing) > 0:
+            t, p, keys = zip(*missing)
+            t, p = np.array(t), np.array(p)
+            new = simAxonStack(subImgSize, wvlen, np.asarray(theta)[t],
+                               np.asarray(phase)[p], b=sinPow)
+            templates[t, p] = new
+
+            # The templates are views of new, which is freed once all of
+            # them leave the bank
+            for i in np.arange(len(keys)):
+                self.add(keys[i], new[i])
+
+        return templates
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, filename=None):
+        """Saves every template of the bank (the ones in memory and the ones
+        previously loaded) to a .npy file. The file is a flat array with the
+        number of templates, their keys and offsets and then their data.
+
+        filename: .npy file, by default the bank's filename"""
+
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            raise ValueError('The template bank has no file to be saved to')
+
+        keys = list(self.stored) + [k for k in self.cache
+                                    if k not in self.stored]
+        sizes = np.array([k[0]**2 for k in keys], dtype=int)
+        header = 1 + 6*len(keys)
+        offsets = header + np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+        tmpName = utils.insertSuffix(filename, '_tmp')
+        data = np.lib.format.open_memmap(tmpName, mode='w+',
+                                         dtype=np.float64,
+                                         shape=(int(header + np.sum(sizes)),))
+        data[0] = len(keys)
+        keysArr = data[1:header].reshape(len(keys), 6)
+        for i in np.arange(len(keys)):
+            keysArr[i] = keys[i] + (offsets[i],)
+            if keys[i] in self.cache:
+                template = self.cache[keys[i]]
+            else:
+                template = self.storedTemplate(keys[i])
+            data[offsets[i]:offsets[i] + sizes[i]] = np.ravel(template)
+        data.flush()
+        del data, keysArr
+
+        # Replacing the file only once it's complete, other processes may be
+        # reading the previous one
+        os.replace(tmpName, filename)
+        self.load(filename)
+
+    def load(self, filename):
+        """Opens a bank saved with save() memory mapped (read only)."""
+
+        self.storedData = np.load(filename, mmap_mode='r')
+        nkeys = int(self.storedData[0])
+        keysArr = np.array(self.storedData[1:1 + 6*nkeys]).reshape(nkeys, 6)
+        self.stored = {self.key(*k[:5]): int(k[5]) for k in keysArr}
+        self.filename = filename
+
+        # Templates now in the file don't need to use memory
+        for key in self.stored:
+            self.cache.pop(key, None)
+
+    def storedTemplate(self, key):
+        offset = self.stored[key]
+        return self.storedData[offset:offset + key[0]**2].reshape(key[0],
+                                                                  key[0])
+
+
+def fromConfig(perfConfig, filename=None):
+    """Sets the .npy file of the shared bank to the one of the performance
+    section of the config file, or to filename if given, and opens it if it
+    exists. Nothing is done if neither is set.
+
+    returns the filename, None if not set"""
+
+    if filename is None:
+        filename = perfConfig.get('Template bank')
+    if filename == '':
+        return None
+
+    filename = os.path.expanduser(filename)
+    if os.path.exists(filename):
+        bank.load(filename)
+    else:
+        bank.filename = filename
+
+    return filename
+
+
+# Bank shared by all the analysis within a process
+bank = TemplateBank()
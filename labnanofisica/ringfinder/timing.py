@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the stages of the ring finder analysis. Stages are marked with
+
+    with timing.timer.stage('smooth'):
+        ...
+
+and the timer records their wall time, the CPU time of the thread that runs
+them and the number of calls, per stage and per file. It's disabled by
+default, and then a stage costs a function call and an attribute check.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class NullStage:
+    """Stage of a disabled timer, it doesn't measure anything."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+nullStage = NullStage()
+
+
+class Stage:
+
+    def __init__(self, timer, name, filename):
+        self.timer = timer
+        self.name = name
+        self.filename = filename
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        self.timer.add(self.name, self.filename, wall, cpu)
+        return False
+
+
+class Timer:
+    """Wall time, CPU time and number of calls of every stage of the
+    analysis, per file.
+
+    Stages record the file given to stage(), or else the one set with
+    setFile in the same thread, so the stages of threads working on
+    different files (like the ones of pipeline.Pipeline) are told apart.
+    Stages run in worker processes are recorded there; see collect and
+    merge to bring them back."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        # (stage, file) -> [wall, cpu, calls]
+        self.records = OrderedDict()
+        self.pid = os.getpid()
+
+    def checkProcess(self):
+        # Worker processes started by forking inherit the records of the main
+        # process, and its lock may be held by another thread
+        if self.pid != os.getpid():
+            self.lock = threading.Lock()
+            self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def setFile(self, filename):
+        """File the stages of the calling thread are recorded for."""
+        self.local.filename = filename
+
+    def stage(self, name, filename=None):
+        if not self.enabled:
+            return nullStage
+
+        if filename is None:
+            filename = getattr(self.local, 'filename', None)
+        return Stage(self, name, filename)
+
+    def add(self, name, filename, wall, cpu, calls=1):
+        self.checkProcess()
+        with self.lock:
+            record = self.records.setdefault((name, filename), [0., 0., 0])
+            record[0] += wall
+            record[1] += cpu
+            record[2] += calls
+
+    def collect(self):
+        """Records taken since the last call, which are removed. Used by
+        worker processes to send them with their results. None if the timer
+        is disabled."""
+
+        if not self.enabled:
+            return None
+
+        self.checkProcess()
+        with self.lock:
+            records = [(name, wall, cpu, calls) for (name, filename),
+                       (wall, cpu, calls) in self.records.items()]
+            self.reset()
+
+        return records
+
+    def merge(self, records, filename=None):
+        """Adds records returned by collect, for the given file."""
+
+        if records is None:
+            return
+
+        if filename is None:
+            filename = getattr(self.local, 'filename', None)
+        for name, wall, cpu, calls in records:
+            self.add(name, filename, wall, cpu, calls)
+
+    def totals(self):
+        """Wall time, CPU time and calls of every stage, for all files."""
+
+        totals = OrderedDict()
+        for (name, filename), record in self.records.items():
+            total = totals.setdefault(name, [0., 0., 0])
+            for i in np.arange(3):
+                total[i] += record[i]
+
+        return totals
+
+    def summary(self, stream=sys.stderr):
+        """Writes a table with the time spent in every stage. Stages can be
+        nested (the templates and correlation ones are part of corrBlocks),
+        so the times don't add up to the total."""
+
+        text = '{0:<14}{1:>8}{2:>11}{3:>11}{4:>13}\n'
+        stream.write(text.format('stage', 'calls', 'wall [s]', 'cpu [s]',
+                                 'ms per call'))
+        for name, (wall, cpu, calls) in self.totals().items():
+            stream.write(text.format(name, calls, '{:.3f}'.format(wall),
+                                     '{:.3f}'.format(cpu),
+                                     '{:.3f}'.format(1000*wall/calls)))
+        stream.flush()
+
+    def dump(self, filename):
+        """Saves the records as json: totals per stage and the times of every
+        stage of every file."""
+
+        def entry(record):
+            return {'wall': record[0], 'cpu': record[1], 'calls': record[2]}
+
+        files = OrderedDict()
+        for (name, f), record in self.records.items():
+            files.setdefault(str(f), OrderedDict())[name] = entry(record)
+
+        stages = OrderedDict((name, entry(record))
+                             for name, record in self.totals().items())
+        with open(filename, 'w') as f:
+            json.dump({'stages': stages, 'files': files}, f, indent=1)
+
+
+def timingName(path):
+    """Default timing file of the batch analysis of a folder."""
+    folder = os.path.split(path)[1]
+    return os.path.join(path, folder + 'timing.json')
+
+
+# Timer of all the analysis within a process
+timer = Timer()
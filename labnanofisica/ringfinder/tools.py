@@ -6,25 +6,52 @@ Created on Sun Aug 14 14:53:28 2016
 """
 
 import os
+import functools
 import numpy as np
 import math
 import configparser
+import multiprocessing as mp
+from scipy import ndimage as ndi
 from scipy.ndimage.measurements import center_of_mass
+from scipy.fftpack import next_fast_len
+from scipy.spatial import cKDTree
 from skimage.feature import peak_local_max
 try:
     import skimage.filters as filters
 except ImportError:
     import skimage.filter as filters
 from skimage.transform import probabilistic_hough_line
-from pyqtgraph.Qt import QtCore, QtGui
-import pyqtgraph as pg
 
-from labnanofisica.ringfinder.neurosimulations import simAxon
+import labnanofisica.ringfinder.templates as templates
+from labnanofisica.ringfinder.neurosimulations import simAxonStack
+from labnanofisica.ringfinder.timing import timer
+
+
+loadingDefaults = {
+    'STORM px nm': '13.3', 'STORM magnification': '10', 'STED px nm': '20'}
+
+analysisDefaults = {
+    'ROI size nm': '1000', 'Gaussian sigma filter nm': '100',
+    'nsigmas threshold': '0.5', 'Lines min length nm': '300',
+    'Ring periodicity nm': '180', 'Sinusoidal pattern power': '6',
+    'Angular step deg': '3', 'Delta angle deg': '20',
+    'Discrimination threshold': '0.12'}
+
+# Settings only set through the config file
+performanceDefaults = {'Band power threshold': '0', 'Worker processes': '0',
+                       'Cache folder': '', 'Cache size MB': '0',
+                       'Direction method': 'tensor', 'Precision': 'double',
+                       'Phase method': 'scan', 'Angle method': 'grid',
+                       'Export images': 'yes', 'Timing': 'no',
+                       'Adaptive levels': '0', 'Adaptive margin': '0.05',
+                       'Decision mode': 'no', 'Template bank': ''}
 
 
 def saveConfig(main):
 
+    # Sections not handled by the GUI are kept
     config = configparser.ConfigParser()
+    config.read(os.path.join(os.getcwd(), 'config'))
 
     config['Loading'] = {
         'STORM px nm': main.STORMPxEdit.text(),
@@ -49,16 +76,9 @@ def saveConfig(main):
 def saveDefaultConfig():
 
     config = configparser.ConfigParser()
-
-    config['Loading'] = {
-        'STORM px nm': '13.3', 'STORM magnification': '10', 'STED px nm': '20'}
-
-    config['Analysis'] = {
-        'ROI size nm': '1000', 'Gaussian sigma filter nm': '100',
-        'nsigmas threshold': '0.5', 'Lines min length nm': '300',
-        'Ring periodicity nm': '180', 'Sinusoidal pattern power': '6',
-        'Angular step deg': '3', 'Delta angle deg': '20',
-        'Discrimination threshold': '0.12'}
+    config['Loading'] = loadingDefaults
+    config['Analysis'] = analysisDefaults
+    config['Performance'] = performanceDefaults
 
     with open(os.path.join(os.getcwd(), 'config'), 'w') as configfile:
         config.write(configfile)
@@ -86,12 +106,45 @@ def loadConfig(main):
     main.corrThresEdit.setText(analysisConfig['Discrimination threshold'])
 
 
+def readConfig(filename=None):
+    """Config file (by default the one in the working directory) with default
+    values for the missing settings."""
+
+    if filename is None:
+        filename = os.path.join(os.getcwd(), 'config')
+
+    config = configparser.ConfigParser()
+    config['Loading'] = loadingDefaults
+    config['Analysis'] = analysisDefaults
+    config['Performance'] = performanceDefaults
+    config.read(filename)
+
+    return config
+
+
+def loadPerformanceConfig():
+    """Performance section of the config file, with default values for the
+    missing settings."""
+    return readConfig()['Performance']
+
+
+def computeDtype(perfConfig):
+    """Float type of the analysis set in the performance section of the
+    config file: 'double' (np.float64) or 'single' (np.float32). Single
+    precision halves the memory use, sums are still accumulated in double."""
+
+    if perfConfig.get('Precision') == 'single':
+        return np.float32
+    else:
+        return np.float64
+
+
 def pearson(a, b):
     """2D pearson coefficient of two matrixes a and b"""
 
     # Subtracting mean values
-    an = a - np.mean(a)
-    bn = b - np.mean(b)
+    an = a - np.mean(a, dtype=np.float64)
+    bn = b - np.mean(b, dtype=np.float64)
 
     # Vectorized versions of c, d, e
     c_vect = an*bn
@@ -99,11 +152,258 @@ def pearson(a, b):
     e_vect = bn*bn
 
     # Finally get r using those vectorized versions
-    r_out = np.sum(c_vect)/math.sqrt(np.sum(d_vect)*np.sum(e_vect))
+    r_out = np.sum(c_vect, dtype=np.float64)/math.sqrt(
+        np.sum(d_vect, dtype=np.float64)*np.sum(e_vect, dtype=np.float64))
 
     return r_out
 
 
+def maskedPearson(data, templates, mask):
+    """Pearson coefficients between data and every template of a stack, with
+    the templates' masked pixels filled with zeros. It gives the same result
+    as [pearson(data, np.ma.array(t, mask=mask).filled(0)) for t in templates]
+    but the data mean and norm are calculated once and all the coefficients
+    come out of a couple of matrix products.
+
+    data: 2D image data
+    templates: array of patterns of shape (..., h, w) or (N, h*w)
+    mask: boolean array with data's shape, True means excluded pixel
+
+    The matrix products are done in the templates' precision and the rest in
+    double precision."""
+
+    n = data.size
+    t = np.reshape(templates, (-1, n))
+
+    # Centered data and weights of the pixels kept in the templates. Since the
+    # data is centered, the template mean doesn't change the numerator.
+    d64 = np.ravel(data) - np.mean(data, dtype=np.float64)
+    d = d64.astype(t.dtype, copy=False)
+    w = np.invert(np.ravel(mask)).astype(t.dtype)
+
+    num, tSum = np.asarray(t.dot(np.stack((d*w, w), 1)).T, dtype=np.float64)
+    tSum2 = np.asarray((t*t).dot(w), dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return num/np.sqrt(np.dot(d64, d64)*(tSum2 - tSum**2/n))
+
+
+def powHarmonics(sinPow):
+    """Fourier series of sin(x)**sinPow, which is a finite sum of harmonics:
+    sin(x)**sinPow = Re(sum(coef[m]*exp(1j*m*x))), m = 0...sinPow
+
+    returns the complex coefficients coef"""
+
+    if sinPow != int(sinPow) or sinPow < 0:
+        raise ValueError('The pattern power must be a natural number')
+
+    # Sampling above the Nyquist rate of the highest harmonic makes the fft
+    # coefficients exact
+    npts = 2*int(sinPow) + 2
+    x = 2*np.pi*np.arange(npts)/npts
+    coef = 2*np.fft.rfft(np.sin(x)**sinPow)[:int(sinPow) + 1]/npts
+    coef[0] /= 2
+
+    # Remove the rounding errors of the null harmonics
+    coef[np.abs(coef) < 1e-12] = 0
+
+    return coef
+
+
+def axonGratingPhase(subImgSize, wvlen, theta, sinPow):
+    """Argument of the sine of simAxon (without the phase term) for each
+    angle of theta, in an array of shape (len(theta), subImgSize**2)."""
+
+    # Same pattern as sin2D within simAxon
+    if sinPow % 2 == 0:
+        wvlen = 2*wvlen
+    X0 = np.arange(1, subImgSize + 1)/subImgSize - .5
+    Xm, Ym = np.meshgrid(X0, X0)
+    thetaRad = np.radians(90 - np.asarray(theta, dtype=float))
+    XYt = (np.cos(thetaRad)[:, np.newaxis]*np.ravel(Xm) +
+           np.sin(thetaRad)[:, np.newaxis]*np.ravel(Ym))
+
+    return XYt*(subImgSize/wvlen)*2*np.pi
+
+
+def phaseCorr(data, mask, theta, wvlen, sinPow, nphase=64):
+    """Correlation of data with the simulated axons of the angles theta,
+    maximized over a continuous phase. It gives the same correlations as
+    maskedPearson for a given phase, but without calculating the templates.
+
+    The pattern sin(v + 2*pi*phase)**sinPow is a sum of sinPow + 1 harmonics
+    of v, and its square one of 2*sinPow + 1 harmonics, so the numerator and
+    the masked template sum and norm of the pearson coefficient are all
+    trigonometric polynomials in the phase. Their coefficients come from a
+    few projections of the data and mask over exp(1j*m*v). The polynomials
+    are then evaluated in a fine phase grid and the maximum is refined with a
+    parabolic interpolation.
+
+    data: 2D image data
+    mask: boolean array with data's shape, True means excluded pixel
+    theta: pattern angles, in deg
+    wvlen: wavelength of the ring pattern, in px
+    sinPow: power of the pattern function, a natural number
+    nphase: number of phase evaluations within the pattern period
+
+    returns:
+
+    corr: maximum correlation for each angle
+    phase: pattern phase of the maximum correlation for each angle"""
+
+    coef = powHarmonics(sinPow)
+    coef2 = powHarmonics(2*sinPow)
+    coef = np.concatenate((coef, np.zeros(len(coef2) - len(coef))))
+
+    # Harmonics present in the pattern or its square
+    m = np.where(np.logical_or(np.abs(coef) > 0, np.abs(coef2) > 0))[0]
+    coef = coef[m]
+    coef2 = coef2[m]
+
+    n = data.size
+    projD, projW, dNorm2 = harmonicProjections(data, mask, theta, wvlen,
+                                               sinPow, m)
+    projD *= coef
+    projW2 = projW*coef2
+    projW *= coef
+
+    def corrPoly(phase):
+        """Correlation for the phases of shape (len(theta), nphases)"""
+        expPhase = np.exp(2j*np.pi*phase[..., np.newaxis]*m)
+        num = np.real(np.sum(projD[:, np.newaxis]*expPhase, -1))
+        tSum = np.real(np.sum(projW[:, np.newaxis]*expPhase, -1))
+        tSum2 = np.real(np.sum(projW2[:, np.newaxis]*expPhase, -1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return num/np.sqrt(dNorm2*(tSum2 - tSum**2/n))
+
+    # All harmonics even means the pattern has half the period in phase
+    period = 0.5 if np.all(m % 2 == 0) else 1
+    phase = np.arange(nphase)*period/nphase
+    corr = corrPoly(phase[np.newaxis])
+
+    i = np.argmax(np.where(np.isnan(corr), -np.inf, corr), 1)
+    phaseMax = phase[i]
+    corrMax = corr[np.arange(len(theta)), i]
+
+    # Parabolic interpolation around the maximum of each angle, repeated with
+    # shorter steps
+    step = period/nphase
+    for it in np.arange(3):
+        c = corrPoly(phaseMax[:, np.newaxis] + np.array([-step, 0, step]))
+        curv = c[:, 0] - 2*c[:, 1] + c[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shift = np.where(curv < 0, 0.5*(c[:, 0] - c[:, 2])/curv, 0)
+        shift = np.clip(np.where(np.isnan(shift), 0, shift), -1, 1)
+        newPhase = (phaseMax + shift*step) % period
+        newCorr = corrPoly(newPhase[:, np.newaxis])[:, 0]
+
+        # Keep the previous maximum if the interpolation didn't improve it
+        better = newCorr > corrMax
+        phaseMax = np.where(better, newPhase, phaseMax)
+        corrMax = np.where(better, newCorr, corrMax)
+        step /= 4
+
+    return corrMax, phaseMax
+
+
+def harmonicProjections(data, mask, theta, wvlen, sinPow, m):
+    """Projections of the masked data (centered with the mean of all pixels)
+    and of the mask over exp(1j*m*v) for each harmonic m, where v is the
+    argument of the sine of simAxon for each angle of theta.
+
+    m: increasing harmonics
+
+    returns the projections of the data and of the mask, of shape
+    (len(theta), len(m)), and the squared norm of the centered data"""
+
+    d = np.ravel(data) - np.mean(data)
+    w = np.invert(np.ravel(mask)).astype(float)
+    dNorm2 = np.dot(d, d)
+
+    v = axonGratingPhase(np.shape(data)[0], wvlen, theta, sinPow)
+    z = np.exp(1j*v)
+    zm = np.ones(z.shape, dtype=complex)
+    projD = np.zeros((len(theta), len(m)), dtype=complex)
+    projW = np.zeros((len(theta), len(m)), dtype=complex)
+    zStep = {1: z}
+    dw = np.stack((d*w, w), 1)
+    for k in np.arange(len(m)):
+        if k > 0:
+            dm = m[k] - m[k - 1]
+            if dm not in zStep:
+                zStep[dm] = z**dm
+            zm *= zStep[dm]
+        projD[:, k], projW[:, k] = zm.dot(dw).T
+
+    return projD, projW, dNorm2
+
+
+def corrBound(data, mask, theta, wvlen, sinPow, maxCond=1e8):
+    """Upper bound of the correlation of data with the simulated axons of the
+    angles theta, for any phase, as given by maskedPearson.
+
+    For a given angle, every masked template is a combination of the mask
+    times cos(m*v) and sin(m*v), for the harmonics m of the pattern (see
+    powHarmonics). The pearson coefficient can't be larger than the one of
+    the data with its projection on the space spanned by them, whose norm
+    comes out of the projections of the data and the mask on a few
+    harmonics (see harmonicProjections). Angles whose space is too close to
+    degenerate for the projection to be reliable get a bound of 1.
+
+    maxCond: maximum condition number of the space's gram matrix
+
+    returns the bound for each angle"""
+
+    # Harmonics of the pattern and the ones their products need
+    h = np.where(np.abs(powHarmonics(sinPow)) > 0)[0]
+    q = np.unique(np.concatenate(
+        (h, np.abs(np.add.outer(h, np.concatenate((h, -h)))).ravel())))
+    projD, projW, dNorm2 = harmonicProjections(data, mask, theta, wvlen,
+                                               sinPow, q)
+    index = {qi: k for k, qi in enumerate(q)}
+
+    def W(k):
+        # Mask projection on harmonic k, which may be negative
+        value = projW[:, index[abs(k)]]
+        return value if k >= 0 else np.conj(value)
+
+    # Basis: mask times cos(m*v) for every harmonic (cos(0) = 1) and times
+    # sin(m*v) for the non null ones
+    basis = [(a, 'cos') for a in h] + [(a, 'sin') for a in h if a > 0]
+    k = len(basis)
+    gram = np.zeros((len(theta), k, k))
+    proj = np.zeros((len(theta), k))
+    total = np.zeros((len(theta), k))
+    for i, (a, fa) in enumerate(basis):
+        part = np.real if fa == 'cos' else np.imag
+        proj[:, i] = part(projD[:, index[a]])
+        total[:, i] = part(W(a))
+        for j, (b, fb) in enumerate(basis):
+            if fa == 'cos' and fb == 'cos':
+                gram[:, i, j] = 0.5*np.real(W(a - b) + W(a + b))
+            elif fa == 'cos':
+                gram[:, i, j] = 0.5*np.imag(W(a + b) - W(a - b))
+            elif fb == 'cos':
+                gram[:, i, j] = 0.5*np.imag(W(a + b) + W(a - b))
+            else:
+                gram[:, i, j] = 0.5*np.real(W(a - b) - W(a + b))
+
+    # Templates are centered with the mean of all pixels
+    gram -= total[:, :, np.newaxis]*total[:, np.newaxis, :]/data.size
+
+    eigval, eigvec = np.linalg.eigh(gram)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm2 = np.sum(np.einsum('tki,tk->ti', eigvec, proj)**2/eigval, 1)
+        bound = np.sqrt(norm2/dNorm2)
+
+    # Rounding errors of the projection, and spaces where it's unreliable
+    bound = bound*(1 + 1e-4) + 1e-6
+    reliable = eigval[:, 0] > eigval[:, -1]/maxCond
+    bound[np.logical_or(~reliable, np.isnan(bound))] = 1
+
+    return np.minimum(bound, 1)
+
+
 def cosTheta(a, b):
     """Angle between two vectors a and b"""
 
@@ -124,8 +424,8 @@ def blockshaped(arr, nrows, ncols):
     each subblock preserving the "physical" layout of arr.
     """
     h, w = arr.shape
-    nrows = np.int(nrows)
-    ncols = np.int(ncols)
+    nrows = int(nrows)
+    ncols = int(ncols)
     return (arr.reshape(h//nrows, nrows, -1, ncols)
                .swapaxes(1, 2)
                .reshape(-1, nrows, ncols))
@@ -201,14 +501,94 @@ def getDirection(data, binary, minLen, debug=False):
         return None, lines
 
 
+def blockDirections(dataS, nrows, ncols, maxSpread=20, halo=0):
+    """Neurite direction of every block of the image, as given by blockshaped,
+    from the structure tensor of the smoothed image. The tensor of the whole
+    image is calculated at once and summed over each block.
+
+    dataS: smoothed image
+    nrows, ncols: block shape
+    maxSpread: maximum angular spread of the gradient for the direction to be
+        valid, in deg. The spread of a neurite's gradient is larger than the
+        one of the lines found by getDirection, hence the higher threshold.
+    halo: width of a border of dataS around the blocks. It's only used for the
+        gradient of the pixels next to it.
+
+    returns:
+
+    th0: direction of each block in deg within [0, 180), in the same
+    convention as getDirection. np.nan if the spread is above maxSpread.
+    spread: angular spread of the gradient within each block, in deg"""
+
+    return tensorDirections(*blockTensor(dataS, nrows, ncols, halo),
+                            maxSpread)
+
+
+def blockTensor(dataS, nrows, ncols, halo=0):
+    """Structure tensor of the smoothed image summed over every block, as
+    given by blockshaped. Tensors of neighbouring blocks can be summed to get
+    the one of a larger block. See blockDirections for the arguments.
+
+    returns its components Jyy, Jxx and Jxy"""
+
+    # gradient along rows (y) and columns (x)
+    gy = ndi.sobel(dataS, 0)
+    gx = ndi.sobel(dataS, 1)
+    if halo > 0:
+        gy = gy[halo:-halo, halo:-halo]
+        gx = gx[halo:-halo, halo:-halo]
+    Jyy = np.sum(blockshaped(gy*gy, nrows, ncols), (1, 2), dtype=np.float64)
+    Jxx = np.sum(blockshaped(gx*gx, nrows, ncols), (1, 2), dtype=np.float64)
+    Jxy = np.sum(blockshaped(gx*gy, nrows, ncols), (1, 2), dtype=np.float64)
+
+    return Jyy, Jxx, Jxy
+
+
+def tensorDirections(Jyy, Jxx, Jxy, maxSpread=20):
+    """Neurite direction and angular spread of the gradient of every block
+    from its structure tensor, see blockDirections."""
+
+    # The gradient is perpendicular to the neurite
+    gradAngle = 0.5*np.degrees(np.arctan2(2*Jxy, Jyy - Jxx))
+    th0 = np.mod(gradAngle + 90, 180)
+
+    # Coherence is the mean resultant length of the doubled gradient angles,
+    # weighted by the squared gradient. Its circular std gives the spread.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coherence = np.hypot(Jyy - Jxx, 2*Jxy)/(Jyy + Jxx)
+        spread = np.degrees(0.5*np.sqrt(-2*np.log(coherence)))
+    spread[np.isnan(spread)] = np.inf
+
+    th0[spread >= maxSpread] = np.nan
+
+    return th0, spread
+
+
+def houghDirections(blocksMask, minLen):
+    """getDirection applied to every block of a mask, as given by blockshaped.
+    Returns the direction of each block, np.nan where it isn't found."""
+
+    directions = np.zeros(len(blocksMask))
+    for i in np.arange(len(blocksMask)):
+        th0, lines = getDirection(None, np.invert(blocksMask[i]), minLen)
+        directions[i] = np.nan if th0 is None else th0
+
+    return directions
+
+
 def linesFromBinary(binaryData, minLen, debug=False):
 
     # find edges
     edges = filters.sobel(binaryData)
 
-    # get directions
-    lines = probabilistic_hough_line(edges, threshold=10, line_length=minLen,
-                                     line_gap=3)
+    # get directions. The hough transform is randomized, a fixed seed makes
+    # the result independent of the process and order of the analysis
+    kwargs = {'threshold': 10, 'line_length': int(minLen), 'line_gap': 3}
+    try:
+        lines = probabilistic_hough_line(edges, rng=0, **kwargs)
+    except TypeError:
+        # scikit-image < 0.19
+        lines = probabilistic_hough_line(edges, seed=0, **kwargs)
 
     if lines == []:
         if debug:
@@ -305,8 +685,38 @@ def fitMethod(data, mask, thres, minLen, thStep, deltaTh, wvlen, sinPow,
                 x1, y1 = xp, yp
 
 
+def goldenMax(func, a, b, tol):
+    """Golden section search of the maximum of func within [a, b].
+
+    func: function of x that returns a tuple (f(x), extra)
+    tol: length of the final interval
+
+    returns x, f(x), extra at the maximum"""
+
+    g = (math.sqrt(5) - 1)/2
+    c = b - g*(b - a)
+    d = a + g*(b - a)
+    fc, extraC = func(c)
+    fd, extraD = func(d)
+    while b - a > tol:
+        if fc > fd:
+            b, d, fd, extraD = d, c, fc, extraC
+            c = b - g*(b - a)
+            fc, extraC = func(c)
+        else:
+            a, c, fc, extraC = c, d, fd, extraD
+            d = a + g*(b - a)
+            fd, extraD = func(d)
+
+    if fc > fd:
+        return c, fc, extraC
+    else:
+        return d, fd, extraD
+
+
 def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
-               developer=False):
+               developer=False, bank=None, phaseMethod='scan',
+               thetaMethod='grid', thTol=0.1, direction=None):
     """Searches for rings by correlating the image data with a given
     sinusoidal pattern
 
@@ -319,11 +729,23 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
     wvlen: wavelength of the ring pattern, in px
     sinPow: power of the pattern function
     developer (bool): enables additional output of algorithms
+    bank: templates.TemplateBank providing the simulated axons. Defaults to
+        the bank shared by the whole process.
+    phaseMethod: 'scan' correlates with 21 phases of the pattern, 'analytic'
+        finds the best phase for each angle in closed form (see phaseCorr)
+    thetaMethod: 'grid' correlates the multiples of thStep within deltaTh
+        from the neurite direction (see angleGrid). 'adaptive' then refines
+        the best angle with a golden section search.
+    thTol: angle precision of the adaptive search, in deg
+    direction: neurite direction given by blockDirections (np.nan if it
+        couldn't be found). If None, it's found with getDirection.
 
     returns:
 
     corrMax: the maximum (in function of the rotated angle) correlation value
     at the image data
+    corrTheta: correlation for each angle of the grid (the coarse one in the
+    adaptive search)
     thetaMax: simulated axon's rotation angle with maximum correlation value
     phaseMax: simulated axon's phase with maximum correlation value at thetaMax
     rings (bool): ring presence"""
@@ -331,12 +753,17 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
     # phase steps are set to 20, TO DO: explore this parameter
     phase = np.arange(0, 21, 1)
 
-    corrPhase = np.zeros(np.size(phase))
-
     neuronFrac = 1 - np.sum(mask)/np.size(mask)
 
     # line angle calculated
-    th0, lines = getDirection(data, np.invert(mask), minLen, developer)
+    if direction is None:
+        with timer.stage('hough'):
+            th0, lines = getDirection(data, np.invert(mask), minLen,
+                                      developer)
+    elif np.isnan(direction):
+        th0 = None
+    else:
+        th0 = direction
 
     if th0 is None:
 
@@ -358,33 +785,50 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
             if developer:
                 theta = np.arange(np.min([th0 - deltaTh, 0]), 180, thStep)
             else:
-                theta = np.arange(th0 - deltaTh, th0 + deltaTh, thStep)
+                theta = angleGrid(th0, thStep, deltaTh)
 
         except TypeError:
             th0 = 90
             deltaTh = 90
             theta = np.arange(0, 180, thStep)
 
-        corrPhaseArg = np.zeros(np.size(theta))
-        corrTheta = np.zeros(np.size(theta))
-
         subImgSize = np.shape(data)[0]
+        if bank is None:
+            bank = templates.bank
 
-        # for now we correlate with the full sin2D pattern
-        for t in np.arange(len(theta)):
-            for p in phase:
-                # creates simulated axon
-                axonTheta = simAxon(subImgSize, wvlen, theta[t], p*.025, a=0,
-                                    b=sinPow).data
-                axonTheta = np.ma.array(axonTheta, mask=mask).filled(0)
+        def corrAngles(theta, shared=True):
+            """Best phase and its correlation for each angle of theta. The
+            simulated axons are read from the bank only if shared."""
 
-                # saves correlation for the given phase p
-                # Unbiasing dependence of corr with area of neuron in block
-                corrPhase[p] = pearson(data, axonTheta)*neuronFrac
+            if phaseMethod == 'analytic':
+                corrTheta, corrPhaseArg = phaseCorr(data, mask, theta, wvlen,
+                                                    sinPow)
 
-            # saves the correlation for the best p, and given angle i
-            corrTheta[t - 1] = np.max(corrPhase)
-            corrPhaseArg[t - 1] = .025*np.argmax(corrPhase)
+            else:
+                # for now we correlate with the full sin2D pattern. All the
+                # simulated axons (every angle and phase) are correlated at
+                # once.
+                with timer.stage('templates'):
+                    if shared:
+                        axons = bank.stack(subImgSize, wvlen, sinPow, theta,
+                                           .025*phase, data.dtype)
+                    else:
+                        axons = simAxonStack(
+                            subImgSize, wvlen, np.repeat(theta, len(phase)),
+                            np.tile(.025*phase, len(theta)), b=sinPow)
+                        axons = axons.astype(data.dtype, copy=False)
+                with timer.stage('correlation'):
+                    corrPhase = maskedPearson(data, axons, mask)
+                corrPhase = corrPhase.reshape(len(theta), len(phase))
+
+                # saves the correlation for the best phase, for every angle
+                corrTheta = np.max(corrPhase, 1)
+                corrPhaseArg = .025*np.argmax(corrPhase, 1)
+
+            # Unbiasing dependence of corr with area of neuron in block
+            return corrTheta*neuronFrac, corrPhaseArg
+
+        corrTheta, corrPhaseArg = corrAngles(theta)
 
         # get theta, phase and correlation with greatest correlation value
         # Find indices within (th0 - deltaTh, th0 + deltaTh)
@@ -395,11 +839,494 @@ def corrMethod(data, mask, minLen, thStep, deltaTh, wvlen, sinPow,
         phaseMax = corrPhaseArg[ix][i]
         corrMax = np.max(corrTheta[ix])
 
+        if thetaMethod == 'adaptive':
+            # Refine the angle between the coarse neighbours of the maximum
+            a = max(thetaMax - thStep, th0 - deltaTh)
+            b = min(thetaMax + thStep, th0 + deltaTh)
+
+            def corrAngle(th):
+                # The angles of the search are different for every block, so
+                # they'd only push the ones of the grid out of the bank
+                corr, phase = corrAngles(np.array([th]), shared=False)
+                return corr[0], phase[0]
+
+            result = goldenMax(corrAngle, a, b, thTol)
+            if result[1] > corrMax:
+                thetaMax, corrMax, phaseMax = result
+
 #        rings = corrMax > thres
 
     return th0, corrTheta, corrMax, thetaMax, phaseMax  # , rings
 
 
+def angleGrid(th0, thStep, deltaTh):
+    """Angles correlated around the neurite direction th0: the multiples of
+    thStep within deltaTh from it, or th0 alone if there are none. Since
+    they're the same for every block, so are their simulated axons, which
+    are reused from the template bank."""
+
+    theta = thStep*np.arange(np.ceil((th0 - deltaTh)/thStep),
+                             np.floor((th0 + deltaTh)/thStep) + 1)
+    if len(theta) == 0:
+        theta = np.array([th0])
+
+    return theta
+
+
+def gridTemplates(thStep, deltaTh):
+    """Number of simulated axons corrMethod correlates the blocks of an image
+    with, for any neurite direction in [0, 180): the 21 phases of every
+    angle of angleGrid."""
+
+    nangles = np.floor((180 + deltaTh)/thStep) - np.ceil(-deltaTh/thStep) + 1
+    return 21*int(nangles)
+
+
+def fillBank(subImgSize, cArgs, bank=None):
+    """Calculates the simulated axons of every angle corrMethod may correlate
+    the blocks with (see gridTemplates) that aren't in the bank yet, so the
+    analysis only reads them. Used to save them all to the bank's file.
+
+    subImgSize: block size in px
+    cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod
+    bank: templates.TemplateBank, by default the one shared by the process
+
+    returns the number of templates that were calculated"""
+
+    minLen, thStep, deltaTh, wvlen, sinPow = cArgs
+    if bank is None:
+        bank = templates.bank
+    bank.reserve(gridTemplates(thStep, deltaTh),
+                 bank.family(subImgSize, wvlen, sinPow))
+
+    misses = bank.misses
+    theta = thStep*np.arange(np.ceil(-deltaTh/thStep),
+                             np.floor((180 + deltaTh)/thStep) + 1)
+    phase = .025*np.arange(0, 21, 1)
+    # A few angles at a time, so the stacks stay small
+    for chunk in np.array_split(theta, max(1, len(theta)//8)):
+        bank.stack(subImgSize, wvlen, sinPow, chunk, phase)
+
+    return bank.misses - misses
+
+
+def corrDecision(data, mask, corrThres, minLen, thStep, deltaTh, wvlen,
+                 sinPow, bank=None, direction=None):
+    """Decision mode of corrMethod: whether the correlation maximum of the
+    block reaches corrThres, correlating as few angles as possible. The angles
+    of the grid are correlated (as in corrMethod, with 21 phases) from the
+    one with the highest bound (see corrBound) down, until one of them
+    reaches corrThres or the bounds of the remaining ones are below it. The
+    decision is the same as corrMax >= corrThres of corrMethod with the
+    default phase and theta methods.
+
+    corrThres: discrimination threshold
+    other arguments: see corrMethod
+
+    returns:
+
+    rings: whether the correlation maximum reaches corrThres
+    corrSeen: maximum correlation of the angles that were correlated, np.nan
+    if none was
+    thetaSeen, phaseSeen: angle and phase of corrSeen
+    boundLeft: bound of the correlation of the angles that weren't
+    correlated, 0 if there are none. All of them are np.nan if the neurite
+    direction isn't found."""
+
+    phase = np.arange(0, 21, 1)
+    neuronFrac = 1 - np.sum(mask)/np.size(mask)
+
+    if direction is None:
+        with timer.stage('hough'):
+            th0 = getDirection(data, np.invert(mask), minLen)[0]
+    elif np.isnan(direction):
+        th0 = None
+    else:
+        th0 = direction
+
+    if th0 is None:
+        return False, np.nan, np.nan, np.nan, np.nan
+
+    theta = angleGrid(th0, thStep, deltaTh)
+    subImgSize = np.shape(data)[0]
+    if bank is None:
+        bank = templates.bank
+
+    with timer.stage('bound'):
+        bounds = corrBound(data, mask, theta, wvlen, sinPow)*neuronFrac
+
+    corrSeen = thetaSeen = phaseSeen = np.nan
+    done = np.zeros(len(theta), dtype=bool)
+    for k in np.argsort(-bounds):
+        if bounds[k] < corrThres or corrSeen >= corrThres:
+            break
+
+        with timer.stage('templates'):
+            axons = bank.stack(subImgSize, wvlen, sinPow, theta[[k]],
+                               .025*phase, data.dtype)
+        with timer.stage('correlation'):
+            corrPhase = maskedPearson(data, axons, mask)
+        corr = np.max(corrPhase)*neuronFrac
+        if np.isnan(corrSeen) or corr > corrSeen:
+            corrSeen = corr
+            thetaSeen = theta[k]
+            phaseSeen = .025*np.argmax(corrPhase)
+        done[k] = True
+
+    rings = bool(corrSeen >= corrThres)
+    boundLeft = np.max(bounds[~done], initial=0)
+
+    return rings, corrSeen, thetaSeen, phaseSeen, boundLeft
+
+
+@functools.lru_cache(maxsize=16)
+def fftRadius(nrows, ncols):
+    """Frequency, in cycles per px, of every element of the rfft2 of an array
+    of shape (nrows, ncols), and its weight in the power spectrum: columns 1
+    to ncols/2 of the real fft stand for two frequencies. They're calculated
+    once for every block shape and they're read only."""
+
+    freq = np.hypot(np.fft.fftfreq(nrows)[:, np.newaxis],
+                    np.fft.rfftfreq(ncols))
+
+    weight = np.full(freq.shape, 2.)
+    weight[:, 0] = 1
+    if ncols % 2 == 0:
+        weight[:, -1] = 1
+
+    freq.flags.writeable = False
+    weight.flags.writeable = False
+    return freq, weight
+
+
+def bandFraction(blocks, fmin, fmax):
+    """Fraction of the power spectrum of each block (without its mean) at
+    frequencies between fmin and fmax, in cycles per px. All blocks are
+    transformed with a single rfft2.
+
+    blocks: array of shape (nblocks, h, w), as returned by blockshaped"""
+
+    blocks = np.asarray(blocks, dtype=float)
+    nblocks, nrows, ncols = blocks.shape
+    freq, weight = fftRadius(nrows, ncols)
+
+    spectrum = np.fft.rfft2(blocks - np.mean(blocks, (1, 2), keepdims=True))
+    power = (spectrum.real**2 + spectrum.imag**2).reshape(nblocks, -1)
+
+    band = np.logical_and(fmin <= freq, freq <= fmax)
+    total = power @ np.ravel(weight)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = (power @ np.ravel(weight*band))/total
+
+    # Flat blocks have no periodicity at all
+    frac[total == 0] = 0
+
+    return frac
+
+
+def bandPower(blocks, wvlen, width=0.25):
+    """Fraction of the power spectrum of each block within the frequency band
+    of the rings. Blocks without rings' periodicity have a low band power.
+
+    blocks: array of shape (nblocks, h, w), as returned by blockshaped
+    wvlen: wavelength of the ring pattern, in px
+    width: relative half width of the frequency band around 1/wvlen"""
+
+    return bandFraction(blocks, (1 - width)/wvlen, (1 + width)/wvlen)
+
+
+def FFTBlocks(blocks, rmin=9, rmax=12):
+    """FFTMethod for all the blocks of an image at once. Instead of looking
+    for the maxima of each block's spectrum, every block is scored with the
+    fraction of its power within the annulus FFTMethod looks for them in.
+
+    blocks: array of shape (nblocks, h, w), as returned by blockshaped
+    rmin, rmax: radius of the annulus, in hundredths of a cycle per px as in
+        FFTMethod (9 -> 220 nm, 12 -> 167 nm for 20 nm px)
+
+    returns the score of every block, between 0 and 1"""
+
+    return bandFraction(blocks, rmin/100, rmax/100)
+
+
+def windowSum(data, size):
+    """Sum of data within every size x size window that fits in it. Element
+    [i, j] is the sum of data[i:i + size, j:j + size]."""
+
+    cum = np.zeros(np.array(data.shape) + 1)
+    cum[1:, 1:] = np.cumsum(np.cumsum(data, 0), 1)
+
+    return (cum[size:, size:] - cum[:-size, size:] - cum[size:, :-size] +
+            cum[:-size, :-size])
+
+
+def corrMap(data, mask, subImgSize, wvlen, sinPow, thStep=3, stride=1,
+            theta=None, bank=None):
+    """Dense version of the correlation method. It correlates every
+    subImgSize x subImgSize window of data, every stride px, with the
+    simulated axons of all angles and phases, using the same masked pearson
+    coefficient of corrMethod. The sums over each window of the data, mask
+    and templates are all correlations calculated through FFT, so the cost is
+    proportional to the number of templates but not to the number of windows.
+
+    data: 2D image data
+    mask: boolean array with data's shape, True means excluded pixel
+    subImgSize: size of the correlation window, in px
+    wvlen: wavelength of the ring pattern, in px
+    sinPow: power of the pattern function
+    thStep: angular step size, the angles go from 0 to 180
+    stride: step between windows, in px
+    theta: angles to use instead of the full range, in deg
+    bank: templates.TemplateBank providing the simulated axons
+
+    returns:
+
+    corr: maximum correlation of each window, unbiased by its neuron fraction
+    as in corrMethod. Element [i, j] belongs to the window starting at
+    data[i*stride, j*stride].
+    thetaMax: angle of the maximum correlation of each window
+    phaseMax: phase of the maximum correlation of each window"""
+
+    s = int(subImgSize)
+    n = s**2
+    h, w = data.shape
+    if theta is None:
+        theta = np.arange(0, 180, thStep)
+    phase = .025*np.arange(0, 21, 1)
+    if bank is None:
+        bank = templates.bank
+
+    weights = np.invert(mask).astype(float)
+    shape = (next_fast_len(h + s - 1), next_fast_len(w + s - 1))
+    fDataW = np.fft.rfft2(data*weights, shape)
+    fWeights = np.fft.rfft2(weights, shape)
+
+    def window(arr):
+        return arr[::stride, ::stride]
+
+    def correlate(fImage, fTemplate):
+        # Valid part of the correlation, subsampled every stride px
+        corr = np.fft.irfft2(fImage*fTemplate, shape)
+        return corr[s - 1:h:stride, s - 1:w:stride]
+
+    # Window sums of the data and the mask
+    dataSum = window(windowSum(data, s))
+    dataVar = window(windowSum(data**2, s)) - dataSum**2/n
+    neuronFrac = window(windowSum(weights, s))/n
+
+    corr = np.full(dataSum.shape, -np.inf)
+    thetaMax = np.full(dataSum.shape, np.nan)
+    phaseMax = np.full(dataSum.shape, np.nan)
+    for th in theta:
+        for ph in phase:
+            template = bank.template(s, wvlen, sinPow, th, ph)[::-1, ::-1]
+            fTemplate = np.fft.rfft2(template, shape)
+            fTemplate2 = np.fft.rfft2(template**2, shape)
+
+            num = correlate(fDataW, fTemplate)
+            tSum = correlate(fWeights, fTemplate)
+            tSum2 = correlate(fWeights, fTemplate2)
+            num -= dataSum*tSum/n
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = num/np.sqrt(dataVar*(tSum2 - tSum**2/n))
+
+            better = r > corr
+            corr[better] = r[better]
+            thetaMax[better] = th
+            phaseMax[better] = ph
+
+    # Windows without neuron or with no correlation at all
+    invalid = np.logical_or(neuronFrac == 0, np.isinf(corr))
+    corr[invalid] = np.nan
+    thetaMax[invalid] = np.nan
+    phaseMax[invalid] = np.nan
+
+    # Unbiasing dependence of corr with area of neuron in window
+    return corr*neuronFrac, thetaMax, phaseMax
+
+
+def corrBlock(block, blockS, mask, thres, cArgs, band=None, bandThres=0,
+              direction=None, corrThres=None, phaseMethod='scan',
+              thetaMethod='grid'):
+    """Correlation method applied to one block of the image, if it passes the
+    intensity and neuron content discrimination.
+
+    block: block of the input image
+    blockS: block of the smoothed input image
+    mask: block of the image binarization, True means background
+    thres: intensity threshold for the smoothed data
+    cArgs: minLen, thStep, deltaTh, wvlen, sinPow arguments of corrMethod
+    band: block's band power (see bandPower)
+    bandThres: minimum band power for the correlation to be calculated
+    direction: neurite direction of the block, see corrMethod
+    corrThres: if given, the block is only correlated until it's known
+        whether it reaches this threshold, see corrDecision. The correlation
+        is then the maximum of the angles that were correlated, which is
+        below corrThres for blocks without rings, or 0 if none was.
+    phaseMethod, thetaMethod: see corrMethod. The decision mode always scans
+        the phases and the angles of the grid.
+
+    returns the correlation maximum (0 for neuron blocks without rings' band
+    power and np.nan for blocks without neuron), and the angle and phase of
+    the simulated axon that gave it (np.nan if not correlated)"""
+
+    # Block may be excluded from the analysis for two reasons. Firstly,
+    # because the intensity for all its pixels may be too low. Secondly,
+    # because the part of the block that belongs toa neuron may be below an
+    # arbitrary 30% of the block. We apply intensity threshold to smoothed
+    # data so we don't catch tiny bright spots outside neurons
+    neuronFrac = 1 - np.sum(mask)/np.size(mask)
+    if np.any(blockS > thres) and neuronFrac > 0.25:
+        # Blocks with no periodicity near the rings' one can't have rings,
+        # there's no need to correlate them
+        if bandThres > 0 and band < bandThres:
+            return 0, np.nan, np.nan
+        elif corrThres is not None:
+            output = corrDecision(block, mask, corrThres, *cArgs,
+                                  direction=direction)
+            rings, corr, theta, phase, bound = output
+            if np.isnan(corr) and not np.isnan(bound):
+                corr = 0
+            return corr, theta, phase
+        else:
+            output = corrMethod(block, mask, *cArgs, direction=direction,
+                                phaseMethod=phaseMethod,
+                                thetaMethod=thetaMethod)
+            angle, corrTheta, corrMax, theta, phase = output
+            return corrMax, theta, phase
+    else:
+        return np.nan, np.nan, np.nan
+
+
+def corrChunk(args):
+    """corrBlock applied to a chunk of blocks, used by the worker processes of
+    corrBlocks. Returns an array of shape (len(blocks), 3)."""
+
+    (blocksInput, blocksInputS, blocksMask, band, thres, cArgs, bandThres,
+     directions, corrThres, phaseMethod, thetaMethod) = args
+
+    # Room for the simulated axons of all the blocks, so they're calculated
+    # once and then reused by the following blocks and images
+    minLen, thStep, deltaTh, wvlen, sinPow = cArgs
+    family = templates.TemplateBank.family(blocksInput.shape[1], wvlen, sinPow)
+    templates.bank.reserve(gridTemplates(thStep, deltaTh), family)
+
+    results = np.zeros((len(blocksInput), 3))
+    for i in np.arange(len(blocksInput)):
+        direction = None if directions is None else directions[i]
+        results[i] = corrBlock(blocksInput[i], blocksInputS[i], blocksMask[i],
+                               thres, cArgs, band[i], bandThres, direction,
+                               corrThres, phaseMethod, thetaMethod)
+
+    return results
+
+
+def initWorker(bankFile, timing):
+    """Initializer of the worker processes of workerPool."""
+    timer.enable(timing)
+    if bankFile is not None and os.path.exists(bankFile):
+        templates.bank.load(bankFile)
+
+
+def workerPool(nworkers):
+    """Pool of nworkers processes for corrBlocks. They're started with spawn,
+    since forking while other threads (the pipeline stages, Qt) hold a lock
+    would leave the workers deadlocked on it. They open the file of the
+    shared template bank, if it has one, and time their stages if the timer
+    is enabled."""
+
+    context = mp.get_context('spawn')
+    return context.Pool(nworkers, initializer=initWorker,
+                        initargs=(templates.bank.filename, timer.enabled))
+
+
+def corrIndexedChunk(args):
+    """corrChunk of a chunk whose block indices are the first argument. The
+    stage times of the worker process are returned with the results."""
+    return args[0], corrChunk(args[1:]), timer.collect()
+
+
+def corrBlocks(blocksInput, blocksInputS, blocksMask, thres, cArgs,
+               bandThres=0, nworkers=1, pool=None, directions=None,
+               callback=None, stopEvent=None, corrThres=None,
+               phaseMethod='scan', thetaMethod='grid'):
+    """Applies corrBlock to every block of an image, as given by blockshaped.
+
+    nworkers: number of worker processes the blocks are split into. 0 means
+        one for each CPU core. With one worker the blocks are analyzed in the
+        current process. The result doesn't depend on it.
+    pool: workerPool with nworkers processes to use instead of
+        starting a new one, so it can be shared by the analysis of many images
+    directions: neurite direction of every block, as given by blockDirections.
+        If None, each block's direction is found with getDirection.
+    callback: function called with the indices of the blocks and their
+        results, an array of shape (len(indices), 3), as soon as each block
+        is analyzed
+    stopEvent: threading.Event that stops the analysis when set. Blocks being
+        analyzed are finished; the ones that weren't analyzed are nan. The
+        pending blocks of a given pool are still analyzed in the background,
+        but their results are discarded.
+    corrThres: discrimination threshold of the decision mode, see corrBlock
+    phaseMethod, thetaMethod: see corrMethod
+
+    returns the correlation, angle and phase of every block, see corrBlock"""
+
+    nblocks = len(blocksInput)
+    wvlen = cArgs[3]
+    if bandThres > 0:
+        band = bandPower(blocksInput, wvlen)
+    else:
+        band = np.zeros(nblocks)
+
+    if nworkers == 0:
+        nworkers = mp.cpu_count()
+    nworkers = min(nworkers, nblocks)
+
+    progressive = callback is not None or stopEvent is not None
+
+    if nworkers <= 1 and not progressive:
+        args = blocksInput, blocksInputS, blocksMask, band, thres, cArgs
+        args += bandThres, directions, corrThres, phaseMethod, thetaMethod
+        return tuple(corrChunk(args).T)
+
+    if progressive:
+        # One block per chunk, so results arrive and the analysis stops with
+        # the latency of a single block
+        chunks = np.array_split(np.arange(nblocks), nblocks)
+    else:
+        # Several chunks per worker so they're all kept busy until the end
+        chunks = np.array_split(np.arange(nblocks), 4*nworkers)
+    args = [(c, blocksInput[c], blocksInputS[c], blocksMask[c], band[c],
+             thres, cArgs, bandThres,
+             None if directions is None else directions[c], corrThres,
+             phaseMethod, thetaMethod)
+            for c in chunks if len(c) > 0]
+
+    results = np.zeros((nblocks, 3))
+    results[:] = np.nan
+
+    def collect(output):
+        for indices, chunkResults, times in output:
+            results[indices] = chunkResults
+            timer.merge(times)
+            if callback is not None:
+                callback(indices, chunkResults)
+            if stopEvent is not None and stopEvent.is_set():
+                return
+
+    if nworkers <= 1:
+        # Stage times are already recorded in this process
+        collect((a[0], corrChunk(a[1:]), None) for a in args)
+    elif pool is None:
+        # Leaving the context terminates the pool and its pending blocks
+        with workerPool(nworkers) as pool:
+            collect(pool.imap_unordered(corrIndexedChunk, args))
+    else:
+        collect(pool.imap_unordered(corrIndexedChunk, args))
+
+    return tuple(results.T)
+
+
 def FFTMethod(data, thres=0.4):
     """A method for actin/spectrin ring finding. It performs FFT 2D analysis
     and looks for maxima at 180 nm in the frequency spectrum."""
@@ -444,111 +1371,67 @@ def FFTMethod(data, thres=0.4):
     return fft2output, coord, (rmin, rmax), rings
 
 
-def pointsMethod(self, data, thres=.3):
+def pointsMethod(data, thres=.3, N=None, dmin=8, dmax=11, minCos=0.8):
     """A method for actin/spectrin ring finding. It finds local maxima in the
     image (points) and then if there are three or more in a row considers that
-    to be rings."""
+    to be rings.
 
-    points = peak_local_max(data, min_distance=6, threshold_rel=thres)
-    points = firstNmax(points, data, N=7)
+    Points i, j, k are in a row if the distances i-j and j-k are between dmin
+    and dmax (in px) and the cosine of the angle between the vectors i-j and
+    j-k is larger than minCos in absolute value. Each triplet is returned
+    once, with i the point of lowest index. All pairs of points within
+    that distance are found with a KD-tree and the triplets they form are
+    checked at once, so every maximum can be used.
 
-    D = []
+    N: number of maxima used, the brightest ones. None uses all of them.
 
-    if points == []:
-        rings = False
+    returns the points, an array of shape (ntriplets, 3, 2) with the points
+    of every triplet in a row, and whether there are rings"""
 
-    else:
-        dmin = 8
-        dmax = 11
-
-        # look up every point
-        for i in np.arange(0, np.shape(points)[0]-1):
-            # calculate the distance of every point to the others
-            for j in np.arange(i + 1, np.shape(points)[0]):
-                d1 = np.linalg.norm(points[i], points[j])
-                # if there are two points at the right distance then
-                if dmin < d1 < dmax:
-                    for k in np.arange(0, np.shape(points)[0]-1):
-                        # check the distance between the last point
-                        # and the other points in the list
-                        if k != i & k != j:
-                            d2 = np.linalg.norm(points[j], points[k])
-
-                        else:
-                            d2 = 0
-
-                        # calculate the angle between vector i-j
-                        # and j-k with i, j, k points
-                        v1 = points[i]-points[j]
-                        v2 = points[j]-points[k]
-                        t = cosTheta(v1, v2)
-
-                        # if point k is at right distance from point j and
-                        # the angle is flat enough
-                        if dmin < d2 < dmax and np.abs(t) > 0.8:
-                            # save the three points and plot the connections
-                            D.append([points[i], points[j], points[k]])
-
-                        else:
-                            pass
-
-        rings = len(D) > 0
-
-    return points, D, rings
-
-
-class Grid:
-
-    def __init__(self, viewbox, shape, n=[10, 10]):
-        self.vb = viewbox
-        self.n = n
-        self.lines = []
-
-        pen = pg.mkPen(color=(255, 255, 0), width=1, style=QtCore.Qt.DotLine,
-                       antialias=True)
-        self.rect = QtGui.QGraphicsRectItem(0, 0, shape[0], shape[1])
-        self.rect.setPen(pen)
-        self.vb.addItem(self.rect)
-        self.lines.append(self.rect)
-
-        step = np.array(shape)/self.n
-
-        for i in np.arange(0, self.n[0] - 1):
-            cx = step[0]*(i + 1)
-            line = QtGui.QGraphicsLineItem(cx, 0, cx, shape[1])
-            line.setPen(pen)
-            self.vb.addItem(line)
-            self.lines.append(line)
-
-        for i in np.arange(0, self.n[1] - 1):
-            cy = step[1]*(i + 1)
-            line = QtGui.QGraphicsLineItem(0, cy, shape[0], cy)
-            line.setPen(pen)
-            self.vb.addItem(line)
-            self.lines.append(line)
-
-
-class SubImgROI(pg.ROI):
-
-    def __init__(self, step, *args, **kwargs):
-        super().__init__([0, 0], [0, 0], translateSnap=True, scaleSnap=True,
-                         *args, **kwargs)
-        self.step = step
-        self.keyPos = (0, 0)
-        self.addScaleHandle([1, 1], [0, 0], lockAspect=True)
-
-    def moveUp(self):
-        self.moveRoi(0, self.step)
-
-    def moveDown(self):
-        self.moveRoi(0, -self.step)
-
-    def moveRight(self):
-        self.moveRoi(self.step, 0)
-
-    def moveLeft(self):
-        self.moveRoi(-self.step, 0)
-
-    def moveRoi(self, dx, dy):
-        self.keyPos = (self.keyPos[0] + dx, self.keyPos[1] + dy)
-        self.setPos(self.keyPos)
+    points = peak_local_max(data, min_distance=6, threshold_rel=thres)
+    if N is not None:
+        order = np.argsort(data[points[:, 0], points[:, 1]])[::-1]
+        points = points[order[:N]]
+
+    D = np.zeros((0, 3, 2), dtype=points.dtype)
+    if len(points) < 3:
+        return points, D, False
+
+    # Pairs of points i < j at the right distance
+    pairs = cKDTree(points).query_pairs(dmax, output_type='ndarray')
+    if len(pairs) > 0:
+        dist = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]],
+                              axis=1)
+        pairs = pairs[np.logical_and(dmin < dist, dist < dmax)]
+    if len(pairs) == 0:
+        return points, D, False
+
+    # Every pair in both directions, sorted by its first point, so the
+    # pairs starting at point j are edges[start[j]:start[j] + count[j]]
+    edges = np.concatenate((pairs, pairs[:, ::-1]))
+    edges = edges[np.argsort(edges[:, 0], kind='stable')]
+    count = np.bincount(edges[:, 0], minlength=len(points))
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+
+    # Triplets: every pair i-j, in both directions, followed by every pair
+    # j-k. Each triplet is then found as i-j-k and k-j-i, only the first one
+    # with i < k is kept.
+    ncont = count[edges[:, 1]]
+    first = np.repeat(np.arange(len(edges)), ncont)
+    offset = np.arange(len(first)) - np.repeat(np.cumsum(ncont) - ncont,
+                                               ncont)
+    i, j = edges[first].T
+    k = edges[start[j] + offset, 1]
+    keep = i < k
+    i, j, k = i[keep], j[keep], k[keep]
+
+    # Angle between the vectors i-j and j-k
+    v1 = (points[i] - points[j]).astype(float)
+    v2 = (points[j] - points[k]).astype(float)
+    cos = np.sum(v1*v2, 1)/(np.linalg.norm(v1, axis=1) *
+                            np.linalg.norm(v2, axis=1))
+    inRow = np.abs(cos) > minCos
+
+    D = np.stack((points[i[inRow]], points[j[inRow]], points[k[inRow]]), 1)
+
+    return points, D, len(D) > 0
@@ -6,10 +6,12 @@ Created on Fri Jul 29 19:27:26 2016
 """
 
 import os
-from tkinter import Tk, filedialog
 
 
+# tkinter is imported only when a dialog is needed, so the rest of the package
+# can be used in machines without it
 def getFilename(title, types, initialdir=None):
+    from tkinter import Tk, filedialog
     root = Tk()
     root.withdraw()
     filename = filedialog.askopenfilename(title=title, filetypes=types,
@@ -19,6 +21,7 @@ def getFilename(title, types, initialdir=None):
 
 
 def getFilenames(title, types=[], initialdir=None):
+    from tkinter import Tk, filedialog
     root = Tk()
     root.withdraw()
     filenames = filedialog.askopenfilenames(title=title, filetypes=types,
@@ -21,6 +21,8 @@ setup(
     keywords="single-molecule imaging",
     url="https://github.com/fedebarabas/LabNanofisica",
     packages=find_packages(),
+    # zarr reads compressed tiff files tile by tile, see ringfinder/slide.py
+    extras_require={'slide': ['zarr']},
 #    long_description=read('README'),
     classifiers=[
         "Intended Audience :: Science/Research",
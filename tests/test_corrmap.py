@@ -0,0 +1,36 @@
+import numpy as np
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.templates as templates
+
+wvlen, sinPow = 9., 6.
+
+
+def test_window_equals_masked_pearson():
+    # Every window of the map is the masked pearson of that block with the
+    # simulated axons of all the angles and phases
+    rng = np.random.RandomState(0)
+    data = rng.poisson(20, (97, 110)).astype(np.float64)
+    mask = rng.rand(*data.shape) < 0.3
+    s, stride = 30, 7
+    theta = np.array([0., 33., 90., 147.])
+    phase = .025*np.arange(0, 21, 1)
+
+    corr, thetaMax, phaseMax = tools.corrMap(data, mask, s, wvlen, sinPow,
+                                             stride=stride, theta=theta)
+    assert corr.shape == ((97 - s)//stride + 1, (110 - s)//stride + 1)
+
+    axons = templates.bank.stack(s, wvlen, sinPow, theta, phase)
+    for i in np.arange(corr.shape[0]):
+        for j in np.arange(corr.shape[1]):
+            window = np.s_[i*stride:i*stride + s, j*stride:j*stride + s]
+            r = tools.maskedPearson(data[window], axons, mask[window])
+            r = r.reshape(len(theta), len(phase))
+            neuronFrac = 1 - np.mean(mask[window])
+            np.testing.assert_allclose(corr[i, j], np.max(r)*neuronFrac,
+                                       rtol=1e-9)
+
+            # Phases half a period apart can give the same template
+            t = np.where(theta == thetaMax[i, j])[0][0]
+            p = np.where(np.isclose(phase, phaseMax[i, j]))[0][0]
+            np.testing.assert_allclose(r[t, p], np.max(r), rtol=1e-9)
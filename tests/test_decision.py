@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import tifffile as tiff
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.pipeline as pipeline
+import labnanofisica.ringfinder.templates as templates
+
+pxSize = 20
+cArgs = (300/pxSize, 3., 20., 180/pxSize, 6.)
+folder = os.path.dirname(tools.__file__)
+
+
+def gatedBlocks():
+    """Blocks of the bundled STED image that pass the discrimination of
+    corrBlock and have a neurite direction, with their masks and
+    directions."""
+
+    data = tiff.imread(os.path.join(folder, 'spectrinSTED.tif'))
+    blocksInput, blocksInputS, blocksMask, thres, directions = (
+        pipeline.prepareImage(data.astype(np.float64), 100/pxSize, 0.5,
+                              (50, 50)))
+    neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+    gate = np.any(blocksInputS > thres, (1, 2)) & (neuronFrac > 0.25)
+    gate &= ~np.isnan(directions)
+    return blocksInput[gate], blocksMask[gate], directions[gate]
+
+
+def test_bound():
+    # The bound of every angle is above the best pearson over the phases
+    blocks, masks, directions = gatedBlocks()
+    assert len(blocks) > 0
+    phase = .025*np.arange(0, 21, 1)
+    for block, mask, th0 in zip(blocks, masks, directions):
+        theta = tools.angleGrid(th0, cArgs[1], cArgs[2])
+        bound = tools.corrBound(block, mask, theta, cArgs[3], cArgs[4])
+        axons = templates.bank.stack(block.shape[0], cArgs[3], cArgs[4],
+                                     theta, phase)
+        corr = tools.maskedPearson(block, axons, mask).reshape(len(theta), -1)
+        assert np.all(bound >= np.max(corr, 1))
+
+
+def test_same_decision():
+    blocks, masks, directions = gatedBlocks()
+    corrMax = np.array([tools.corrMethod(b, m, *cArgs, direction=d)[2]
+                        for b, m, d in zip(blocks, masks, directions)])
+    for corrThres in (0.08, 0.12, 0.2):
+        rings = [tools.corrDecision(b, m, corrThres, *cArgs, direction=d)[0]
+                 for b, m, d in zip(blocks, masks, directions)]
+        np.testing.assert_array_equal(rings, corrMax >= corrThres)
@@ -0,0 +1,29 @@
+import numpy as np
+
+from labnanofisica.ringfinder.neurosimulations import simAxon, simAxonStack
+
+
+def test_stack_equals_simaxon():
+    # Bit-identical to simAxon for random parameters, odd and even powers and
+    # with and without the envelope
+    rng = np.random.RandomState(0)
+    for n in np.arange(200):
+        imSize = rng.randint(10, 60)
+        wvlen = rng.uniform(3, 20)
+        theta = rng.uniform(-30, 210)
+        phase = rng.rand()
+        a = rng.randint(0, 2)
+        b = rng.randint(1, 7)
+        stack = simAxonStack(imSize, wvlen, theta, phase, a, b)
+        assert stack.shape == (1, imSize, imSize)
+        expected = simAxon(imSize, wvlen, theta, phase, a, b).data
+        np.testing.assert_array_equal(stack[0], expected)
+
+
+def test_broadcast():
+    theta = np.array([0., 33., 90., 147.5])
+    phase = np.array([0, .25, .5, .975])
+    stack = simAxonStack(40, 9., theta, phase, b=6.)
+    for i in np.arange(len(theta)):
+        np.testing.assert_array_equal(
+            stack[i], simAxon(40, 9., theta[i], phase[i], b=6.).data)
@@ -0,0 +1,19 @@
+import numpy as np
+
+import labnanofisica.ringfinder.tools as tools
+
+
+def test_masked_pearson():
+    # Same coefficients as the pearson of the data and each template with its
+    # masked pixels filled with zeros
+    rng = np.random.RandomState(0)
+    for n in np.arange(20):
+        data = rng.poisson(20, (25, 25)).astype(np.float64)
+        mask = rng.rand(25, 25) < rng.uniform(0, 0.7)
+        stack = rng.rand(4, 3, 25, 25)
+        corr = tools.maskedPearson(data, stack, mask)
+
+        expected = [tools.pearson(data, np.ma.array(t, mask=mask).filled(0))
+                    for t in stack.reshape(-1, 25, 25)]
+        np.testing.assert_allclose(corr, expected, rtol=1e-10)
+
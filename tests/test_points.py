@@ -0,0 +1,60 @@
+import itertools
+import numpy as np
+
+import labnanofisica.ringfinder.tools as tools
+
+
+def spots(shape, centers, heights, sigma=1.5):
+    y, x = np.indices(shape)
+    image = np.zeros(shape)
+    for (cy, cx), h in zip(centers, heights):
+        image += h*np.exp(-((y - cy)**2 + (x - cx)**2)/(2*sigma**2))
+    return image
+
+
+def bruteForce(points, dmin=8, dmax=11, minCos=0.8):
+    """Triplets of pointsMethod, checking every combination of points."""
+
+    triplets = set()
+    for i, j, k in itertools.permutations(np.arange(len(points)), 3):
+        if i > k:
+            continue
+        v1 = (points[i] - points[j]).astype(float)
+        v2 = (points[j] - points[k]).astype(float)
+        d1, d2 = np.linalg.norm(v1), np.linalg.norm(v2)
+        if dmin < d1 < dmax and dmin < d2 < dmax:
+            if np.abs(np.dot(v1, v2)/(d1*d2)) > minCos:
+                triplets.add(tuple(np.concatenate((points[i], points[j],
+                                                   points[k]))))
+    return triplets
+
+
+def test_brightest_in_the_middle():
+    # peak_local_max sorts the maxima by intensity, so the middle one is the
+    # first point
+    image = spots((40, 60), [(20, 20), (20, 30), (20, 40)], [1, 2, 1])
+    points, D, rings = tools.pointsMethod(image)
+    assert len(points) == 3
+    assert tuple(points[0]) == (20, 30)
+    assert len(D) == 1
+    assert rings
+    np.testing.assert_array_equal(D[0, 1], (20, 30))
+
+
+def test_random_points():
+    # Jittered lattice of 9.5 px with missing points, so there are pairs at
+    # and out of the right distance and rows at many angles
+    rng = np.random.RandomState(0)
+    lattice = 9.5*np.indices((7, 7)).reshape(2, -1).T + 6
+    ntriplets = 0
+    for n in np.arange(20):
+        centers = lattice + rng.uniform(-1.5, 1.5, lattice.shape)
+        centers = centers[rng.rand(len(centers)) < 0.7]
+        image = spots((70, 70), centers, rng.uniform(0.5, 1, len(centers)))
+        points, D, rings = tools.pointsMethod(image)
+        ntriplets += len(D)
+        found = {tuple(np.ravel(t)) for t in D}
+        assert len(found) == len(D)
+        assert found == bruteForce(points)
+        assert rings == (len(found) > 0)
+    assert ntriplets > 100
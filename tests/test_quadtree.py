@@ -0,0 +1,89 @@
+import numpy as np
+import tifffile as tiff
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.pipeline as pipeline
+import labnanofisica.ringfinder.quadtree as quadtree
+
+pxSize = 20
+cArgs = (300/pxSize, 3., 20., 180/pxSize, 6.)
+n = (12, 12)
+
+
+def neurites(blockSize=50, seed=0):
+    """Image of n blocks with straight neurites that have rings only along
+    half of their length, so nodes mix blocks with and without rings."""
+
+    rng = np.random.RandomState(seed)
+    y, x = np.indices((n[0]*blockSize, n[1]*blockSize)).astype(float)
+    image = np.zeros(x.shape)
+    for angle, offset in [(0, 150), (30, 300), (90, 420), (120, 200),
+                          (10, 520)]:
+        t = np.radians(angle)
+        across = -np.sin(t)*x + np.cos(t)*y - offset
+        along = np.cos(t)*x + np.sin(t)*y
+        rings = along % 400 < 200
+        pattern = np.where(rings, 0.5 + 0.5*np.cos(np.pi*along/cArgs[3])**2,
+                           0.75)
+        image += 100*np.exp(-across**2/(2*8.**2))*pattern
+
+    return rng.poisson(image + 5).astype(np.float64)
+
+
+def test_max_levels():
+    assert quadtree.maxLevels(9.) == 2
+    assert quadtree.maxLevels(4.) == 0
+    for wvlen in (4.5, 8., 9., 17., 40.):
+        levels = quadtree.maxLevels(wvlen)
+        assert wvlen/2**levels > 2
+        assert wvlen/2**(levels + 1) <= 2
+
+
+def test_levels_clamped(tmp_path):
+    data = neurites()
+    filename = str(tmp_path / 'neurites.tif')
+    tiff.imwrite(filename, data.astype(np.uint16))
+    blocks = pipeline.prepareImage(data, 100/pxSize, 0.5,
+                                   np.array(data.shape)/n[0])
+    tree = quadtree.analyzeAdaptive(blocks, n, cArgs, 0.3, levels=5)
+    assert tree.levels == 2
+    analysis = pipeline.Pipeline([filename], pxSize, 0, 100, 0.5, cArgs,
+                                 nworkers=1, levels=5, corrThres=0.3)
+    analysis.close()
+    assert analysis.levels == 2
+
+
+def test_same_rings():
+    # Blocks are never given the correlation of their node, so the rings are
+    # the ones of the full analysis for any threshold
+    data = neurites()
+    blocks = pipeline.prepareImage(data, 100/pxSize, 0.5,
+                                   np.array(data.shape)/n[0])
+    full = tools.corrBlocks(*blocks[:4], cArgs,
+                            directions=blocks[4])[0].reshape(n)
+    for corrThres in (0.2, 0.3, 0.4):
+        for levels in (1, 2):
+            tree = quadtree.analyzeAdaptive(blocks, n, cArgs, corrThres,
+                                            levels)
+            corr = tree.rasterize()[0]
+            np.testing.assert_array_equal(np.isnan(corr), np.isnan(full))
+            np.testing.assert_array_equal(corr >= corrThres,
+                                          full >= corrThres)
+            correlated = ~np.isnan(corr) & (corr != 0)
+            np.testing.assert_allclose(corr[correlated], full[correlated])
+
+
+def test_block_bound():
+    # Blocks pruned by their bound can't reach the correlation of corrMethod
+    data = neurites()
+    blocksInput, blocksInputS, blocksMask, thres, directions = (
+        pipeline.prepareImage(data, 100/pxSize, 0.5,
+                              np.array(data.shape)/n[0]))
+    neuronFrac = 1 - np.mean(blocksMask, (1, 2))
+    gate = np.any(blocksInputS > thres, (1, 2)) & (neuronFrac > 0.25)
+    for ix in np.where(gate & ~np.isnan(directions))[0]:
+        corrMax = tools.corrMethod(blocksInput[ix], blocksMask[ix], *cArgs,
+                                   direction=directions[ix])[2]
+        bound = quadtree.blockBound(blocksInput[ix], blocksMask[ix],
+                                    directions[ix], cArgs)
+        assert bound >= corrMax
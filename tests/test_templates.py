@@ -0,0 +1,73 @@
+import os
+import pytest
+import numpy as np
+import tifffile as tiff
+from scipy import ndimage as ndi
+
+import labnanofisica.ringfinder.tools as tools
+import labnanofisica.ringfinder.templates as templates
+
+pxSize = 20
+cArgs = (300/pxSize, 3., 20., 180/pxSize, 6.)
+folder = os.path.dirname(tools.__file__)
+
+
+def neuronBlocks():
+    """Blocks of the bundled STED image with a neuron, and their masks."""
+
+    data = tiff.imread(os.path.join(folder, 'spectrinSTED.tif'))
+    data = data[:300, :300].astype(np.float64)
+    smooth = ndi.gaussian_filter(data, 100/pxSize)
+    blocks = tools.blockshaped(data, 50, 50)
+    masks = tools.blockshaped(smooth < np.percentile(smooth, 70), 50, 50)
+    neuron = np.mean(masks, (1, 2)) < 0.75
+    return blocks[neuron], masks[neuron]
+
+
+def test_second_image_hits():
+    # Blocks share the angle grid, so an identical second image is
+    # correlated only with templates already in the bank
+    bank = templates.TemplateBank()
+
+    def analyze(blocks, masks):
+        return [tools.corrMethod(b, m, *cArgs, bank=bank)[2]
+                for b, m in zip(blocks, masks)]
+
+    blocks, masks = neuronBlocks()
+    first = analyze(blocks, masks)
+    misses = bank.misses
+    assert misses > 0
+    assert misses <= tools.gridTemplates(cArgs[1], cArgs[2])
+    assert bank.hits > 0
+
+    # Every template of the first image is a hit the second time
+    hits = bank.hits
+    second = analyze(blocks, masks)
+    assert bank.misses == misses
+    assert bank.hits - hits == misses + hits
+    np.testing.assert_array_equal(first, second)
+
+
+def test_angle_grid():
+    theta = tools.angleGrid(47.3, 3., 20.)
+    np.testing.assert_allclose(theta, np.arange(30, 67, 3))
+    np.testing.assert_array_equal(tools.angleGrid(10.5, 30., 5.), [10.5])
+
+
+def test_save_load(tmp_path):
+    filename = str(tmp_path / 'bank.npy')
+    bank = templates.TemplateBank()
+    assert tools.fillBank(50, cArgs, bank) == tools.gridTemplates(3., 20.)
+    bank.save(filename)
+
+    loaded = templates.TemplateBank(filename=filename)
+    assert tools.fillBank(50, cArgs, loaded) == 0
+    assert len(loaded.cache) == 0
+    template = loaded.template(50, cArgs[3], cArgs[4], 33., .5)
+    np.testing.assert_array_equal(
+        template, bank.template(50, cArgs[3], cArgs[4], 33., .5))
+
+
+def test_save_without_file():
+    with pytest.raises(ValueError):
+        templates.TemplateBank().save()